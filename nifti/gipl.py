@@ -50,8 +50,8 @@ class GiplType:
 
 class GiplWriter(RawWriter):
 
-    def __init__(self,filename):
-        RawWriter.__init__(self,filename)
+    def __init__(self,filename,gzip=False,level=6,threads=1):
+        RawWriter.__init__(self,filename,gzip,level,threads)
 
         self.offset = 256
         self.pixdim = [1.0, 1.0, 1.0] # not inc qfac
@@ -66,30 +66,27 @@ class GiplWriter(RawWriter):
     def writeVal(self, addr, fmt, n, data):
 
         # write the value
-        self.fh.seek(addr)
         elts = len(data)
         str = self.order + fmt * elts
-        bytes = struct.pack(str, *data)
-        self.fh.write(bytes)
+        struct.pack_into(str, self.header, addr, *data)
 
         # pad remaining length with zero values
         if elts < n:
+            addr += struct.calcsize(str)
             str = self.order + fmt * (n - elts)
             if fmt == 'c':
-                bytes = struct.pack(str, *('\x00' * (n - elts)))
+                struct.pack_into(str, self.header, addr, *('\x00' * (n - elts)))
             else:
-                bytes = struct.pack(str, *((0,) * (n - elts)))
-            self.fh.write(bytes)
+                struct.pack_into(str, self.header, addr, *((0,) * (n - elts)))
 
     def writeHeader(self):
-        self.fh.seek(0)
-        self.fh.write('\x00'*256)
+        RawWriter.writeHeader(self)
 
         my_pixdim = [1.0,1.0,1.0,1.0]
         my_pixdim[0:len(self.pixdim)] = self.pixdim[0:4]
 
         # write data block
-        self.writeVal(0,   "H", 4, numpy.shape(self.data)) # dim
+        self.writeVal(0,   "H", 4, self.shape()) # dim
         self.writeVal(8,   "H", 1, (GiplType.Map[self.type],)) # type
         self.writeVal(10,  "f", 4, my_pixdim) # pixdim
         self.writeVal(26,  "c",80, self.descrip) # description
@@ -102,7 +99,3 @@ class GiplWriter(RawWriter):
         self.writeVal(252, "I", 1, (GiplType.Magic,))
         # if self.ext:
         #     self.writeVal(244, "I", 1, (GiplType.MagicExt,))
-
-    def write(self):
-        self.writeHeader()
-        RawWriter.write(self)
@@ -25,8 +25,8 @@ import numpy
 
 class NiiWriter(RawWriter):
 
-    def __init__(self,filename,descrip=""):
-        RawWriter.__init__(self,filename)
+    def __init__(self,filename,descrip="",gzip=False,level=6,threads=1):
+        RawWriter.__init__(self,filename,gzip,level,threads)
 
         self.offset = 352
         self.pixdim = [1.0, 1.0, 1.0] # not inc qfac
@@ -37,6 +37,8 @@ class NiiWriter(RawWriter):
         self.qdata = [0.0,] * 6
         self.sdata = [0.0,] * 12
         self.one_padding = False
+        self.scl_slope = None # unset: data are stored unscaled
+        self.scl_inter = None
 
     def set_one_padding(self,value):
         self.one_padding = value
@@ -44,41 +46,37 @@ class NiiWriter(RawWriter):
     def writeVal(self, addr, fmt, n, data, padding=None):
 
         # write the value
-        self.fh.seek(addr)
         elts = len(data)
         str = self.order + fmt * elts
-        bytes = struct.pack(str, *data)
-        self.fh.write(bytes)
+        struct.pack_into(str, self.header, addr, *data)
 
         if elts < n:
+            addr += struct.calcsize(str)
 
             # pad remaining length with zero values
             if padding is None:
                 str = self.order + fmt * (n - elts)
                 if fmt == 'c':
-                    bytes = struct.pack(str, *('\x00' * (n - elts)))
+                    struct.pack_into(str, self.header, addr, *('\x00' * (n - elts)))
                 else:
-                    bytes = struct.pack(str, *((0,) * (n - elts)))
-                self.fh.write(bytes)
+                    struct.pack_into(str, self.header, addr, *((0,) * (n - elts)))
 
             # pad with given value repeatedly
             else:
                 str = self.order + fmt * (n - elts)
-                bytes = struct.pack(str, *((padding,) * (n - elts)))
-                self.fh.write(bytes)
+                struct.pack_into(str, self.header, addr, *((padding,) * (n - elts)))
 
 
     def writeHeader(self):
-        self.fh.seek(0)
-        self.fh.write('\x00'*348)
+        RawWriter.writeHeader(self)
 
         self.writeVal(0,   'i',  1, (348,)) # sizeof_hdr
-        self.writeVal(40,  'h',  1, (numpy.rank(self.data),))
+        self.writeVal(40,  'h',  1, (len(self.shape()),))
 
         if self.one_padding:
-            self.writeVal(42,  'h',  7, numpy.shape(self.data), 1)
+            self.writeVal(42,  'h',  7, self.shape(), 1)
         else:
-            self.writeVal(42,  'h',  7, numpy.shape(self.data))
+            self.writeVal(42,  'h',  7, self.shape())
 
         self.writeVal(70,  'h',  1, (self.type,))
         self.writeVal(72,  'h',  1, (NiftiType.Map[self.type][3],))
@@ -90,7 +88,10 @@ class NiiWriter(RawWriter):
 
         self.writeVal(108, 'f',  7, (352.0,)) # vox_offset
 
-        if self.one_padding:
+        if self.scl_slope is not None:
+            self.writeVal(112, 'f',  1, (self.scl_slope,)) # scl_slope
+            self.writeVal(116, 'f',  1, (self.scl_inter,)) # scl_inter
+        elif self.one_padding:
             self.writeVal(112, 'f',  1, (1.0,)) # scl_slope
             self.writeVal(116, 'f',  1, (0.0,)) # scl_inter
 
@@ -104,7 +105,3 @@ class NiiWriter(RawWriter):
 
         self.writeVal(256, 'f',  6, self.qdata)
         self.writeVal(76,  'f',  1, (self.qfac,))
-
-    def write(self):
-        self.writeHeader()
-        RawWriter.write(self)
@@ -22,8 +22,9 @@
 
 import struct
 import sys
+import os
+import zlib
 import numpy
-import gzip
 
 class NiftiType:
 
@@ -50,8 +51,8 @@ class NiftiType:
         # Type:  ( NArray , NArrayShort, Pack , Bitpix )
         # Type name = NumPy string = Nifti #define
         Bool:    ( "Bool", "", "c", 1 ),
-        Int8:    ( "Int8", "", "b", 8 ),
-        UInt8:   ( "UInt8", "", "B", 8 ),
+        Int8:    ( "Int8", "i1", "b", 8 ),
+        UInt8:   ( "UInt8", "u1", "B", 8 ),
         Int16:   ( "Int16", "i2", "h", 16 ),
         UInt16:  ( "UInt16", "u2", "H", 16 ),
         Int32:   ( "Int32", "i4", "i", 32 ),
@@ -62,15 +63,120 @@ class NiftiType:
         Complex128: ( "Complex128", "", "dd", 128 ),
     }
 
+# Type by NumPy short string (eg "u2")
+NiftiType.ByShort = dict([(v[1], k) for (k, v) in NiftiType.Map.items() if v[1]])
+
+def gzip_member(job):
+    """Compress job = (data, level) as one complete gzip member"""
+    data, level = job
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = c.compress(data) + c.flush()
+    return ('\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff' + body +
+            struct.pack('<II', zlib.crc32(data) & 0xffffffffL,
+                        len(data) & 0xffffffffL))
+
+gzip_pool = None
+gzip_pool_key = None
+
+def gzip_threads(threads):
+    """A pool of compression threads, shared by all writers in a process"""
+    global gzip_pool, gzip_pool_key
+
+    # threads don't survive a fork, so a child makes its own pool
+    key = (threads, os.getpid())
+    if gzip_pool_key != key:
+        from multiprocessing.pool import ThreadPool
+        gzip_pool = ThreadPool(threads)
+        gzip_pool_key = key
+    return gzip_pool
+
+def copy_range(filename, start, length, fh):
+    """Copy length bytes from start of the file filename onto fh"""
+    src = file(filename, 'rb')
+    try:
+        src.seek(start)
+        while length > 0:
+            data = src.read(min(length, GzipStream.blocksize))
+            if not data:
+                raise IOError("%s: short read" % (filename,))
+            fh.write(data)
+            length -= len(data)
+    finally:
+        src.close()
+
+class GzipStream:
+    """
+    Write-only gzip stream onto the file-like fh.  Data are cut into
+    blocks which are compressed independently (by several threads, if
+    asked) and written as concatenated gzip members, which gzip and
+    zlib-based readers accept as one stream
+    """
+
+    blocksize = 1 << 22
+
+    def __init__(self, fh, level=6, threads=1):
+        self.fh = fh
+        self.level = level
+        self.threads = max(1, threads)
+        self.pending = []
+        self.pendlen = 0
+        self.members = 0
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pendlen += len(data)
+        if self.pendlen >= self.blocksize * self.threads:
+            self.flush(False)
+
+    def flush(self, final):
+        data = ''.join(self.pending)
+        n = len(data)
+        if not final:
+            n -= n % self.blocksize
+
+        jobs = [(data[i:i+self.blocksize], self.level)
+                for i in range(0, n, self.blocksize)]
+
+        if final and not jobs and not self.members:
+            jobs = [('', self.level)]
+
+        if self.threads > 1 and len(jobs) > 1:
+            members = gzip_threads(self.threads).map(gzip_member, jobs)
+        else:
+            members = map(gzip_member, jobs)
+
+        for m in members:
+            self.fh.write(m)
+        self.members += len(members)
+
+        self.pending = [data[n:]]
+        self.pendlen = len(data) - n
+
+    def finish(self):
+        self.flush(True)
+
 class RawWriter:
+    """
+    Writes a fixed-size header then raw voxel data, in one forward pass:
+    the header is built in memory (see writeHeader), so the target can
+    be a file name, "-" for stdout, or any object with a write() method
+    """
 
-    def __init__(self,filename,gzip=False):
+    def __init__(self,filename,gzip=False,level=6,threads=1):
         self.filename = filename
-    
+
+        if filename == "-":
+            self.target = sys.stdout
+        elif hasattr(filename, "write"):
+            self.target = filename
+        else:
+            self.target = file(filename, 'wb')
+
         if gzip:
-            self.fh = gzip.GzipFile(filename, 'wb')
+            self.fh = GzipStream(self.target, level, threads)
         else:
-            self.fh = file(filename, 'wb')
+            self.fh = self.target
+        self.pos = 0
 
         # currently expect user to set:
         self.type = NiftiType.Int16
@@ -78,21 +184,104 @@ class RawWriter:
         self.offset = 0
         self.order = "<"
 
-    def write(self):
-        self.fh.close()
-        nastr   = self.order + NiftiType.Map[self.type][1]
-        dim = self.data.shape
-    
-        flat = numpy.reshape(self.data, dim[0]*dim[1]*dim[2], order="F")
-        mm   = numpy.memmap(self.filename, dtype=nastr, mode="r+",
-                offset=self.offset, shape=(dim[0]*dim[1]*dim[2],))
-        mm[:] = flat[:]
-        del mm
-
-        self.fh = file(self.filename, 'rb+')
-
-        # self.fh.seek(self.offset)
-        # packstr = self.order + NiftiType.Map[self.type][2]
-        # for e in flat:
-        #     bytes = struct.pack(packstr, int(e)) # numpy-related fix
-        #     self.fh.write(bytes)
+        # for files written a volume at a time (see start()), the full
+        # dimensions; otherwise taken from data
+        self.dims = None
+
+        # filled in by writeHeader
+        self.header = None
+
+    def shape(self):
+        if self.dims is not None:
+            return tuple(self.dims)
+        return self.data.shape
+
+    def writeHeader(self):
+        """Build the header, self.offset bytes, in self.header"""
+        self.header = bytearray(self.offset)
+
+    def emit(self, data):
+        self.fh.write(data)
+        self.pos += len(data)
+
+    def pad(self, offset):
+        """Write zeros up to offset"""
+        while self.pos < offset:
+            self.emit('\x00' * min(offset - self.pos, GzipStream.blocksize))
+
+    def writeData(self, data, offset):
+        nastr = self.order + NiftiType.Map[self.type][1]
+
+        # the file only goes forwards; anything skipped is zero
+        if offset < self.pos:
+            raise IOError("%s: can't write data out of order" % (self.filename,))
+        self.pad(offset)
+
+        # data is often a flipped or transposed view: rather than copy
+        # it all into Fortran order, take slabs of whole planes along
+        # the last axis, each copied (and converted) in turn.  Fortran
+        # order is the C order of the transpose
+        data = numpy.atleast_1d(data)
+        plane = data.size / data.shape[-1] * numpy.dtype(nastr).itemsize
+        step = max(1, GzipStream.blocksize / max(1, plane))
+        for k in range(0, data.shape[-1], step):
+            slab = numpy.ascontiguousarray(data[..., k:k+step].T, nastr)
+            if isinstance(self.fh, file):
+                slab.tofile(self.fh)
+            else:
+                self.fh.write(slab.tostring())
+            self.pos += slab.nbytes
+
+    def copyData(self, ranges, offset):
+        """
+        Write data which are already in file order and type as the byte
+        ranges (filename, start, length) of other files, concatenated
+        """
+        if offset < self.pos:
+            raise IOError("%s: can't write data out of order" % (self.filename,))
+        self.pad(offset)
+
+        for filename, start, length in ranges:
+            copy_range(filename, start, length, self.fh)
+            self.pos += length
+
+    def write(self, ranges=None):
+        """Write the whole file, from self.data or the ranges (see copyData)"""
+        self.start()
+        if ranges:
+            self.copyData(ranges, self.offset)
+        else:
+            self.writeData(self.data, self.offset)
+        self.close()
+
+    def start(self):
+        """Write the header for dims; fill with writeVolume, then close"""
+        self.writeHeader()
+        self.emit(str(self.header))
+
+    def nbytes(self):
+        bytes = NiftiType.Map[self.type][3] / 8
+        for d in self.shape():
+            bytes *= d
+        return bytes
+
+    def writeVolume(self, t, data, ranges=None):
+        """Write 3D data (or the ranges) as volume t of a file set up by start()"""
+        offset = self.offset + t * data.size * NiftiType.Map[self.type][3] / 8
+        if ranges:
+            self.copyData(ranges, offset)
+        else:
+            self.writeData(data, offset)
+
+    def close(self):
+        # volumes never written are zero
+        self.pad(self.offset + self.nbytes())
+
+        if self.fh is not self.target:
+            self.fh.finish()
+
+        # leave stdout and file-like targets open for the caller
+        if isinstance(self.filename, str) and self.filename != "-":
+            self.target.close()
+        else:
+            self.target.flush()
@@ -31,10 +31,24 @@ import math
 import string
 import pprint
 import fnmatch
+import shelve
+import stat
+import threading
+import Queue
+import collections
+import itertools
+import StringIO
+import hashlib
+from collections import OrderedDict
 from datetime import datetime
 import numpy as np
 from os.path import basename
 
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
 ver = map(int, string.split(
     re.sub(r'rc\d+$','',string.split(sys.version)[0]),"."))
 
@@ -43,6 +57,99 @@ if ver < [2,4,0]:
     def set(x):
         return Set(x)
 
+def list_dir(path):
+    """
+    Generate (path, kind) for the entries of directory path, where kind
+    is 'dir' for a directory to descend into, 'file', or 'skip' for a
+    symlink to a directory (as os.path.walk treats them).  With the
+    scandir module, entry types come from the directory itself, saving
+    a stat per file.  An unreadable directory has no entries
+    """
+    try:
+        if scandir is not None:
+            entries = scandir(path)
+        else:
+            entries = os.listdir(path)
+    except OSError:
+        return
+
+    for e in entries:
+        if scandir is not None:
+            px = e.path
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    kind = 'dir'
+                elif e.is_symlink() and e.is_dir():
+                    kind = 'skip'
+                else:
+                    kind = 'file'
+            except OSError:
+                kind = 'file'
+        else:
+            px = os.path.join(path,e)
+            try:
+                mode = os.lstat(px).st_mode
+            except OSError:
+                mode = 0
+            if stat.S_ISDIR(mode):
+                kind = 'dir'
+            elif stat.S_ISLNK(mode) and os.path.isdir(px):
+                kind = 'skip'
+            else:
+                kind = 'file'
+        yield px, kind
+
+# Linux FS_IOC_FIEMAP, and struct fiemap with room for one extent
+FS_IOC_FIEMAP = 0xc020660b
+fiemap_head = "=QQIIII"
+fiemap_extent = "=QQQQQIIII"
+
+def first_extent(f):
+    """
+    Physical offset of the first extent of file f, where the filesystem
+    will say (Linux FIEMAP); otherwise None
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return None
+
+    req = struct.pack(fiemap_head, 0, 0xffffffffffffffffL, 0, 0, 1, 0) + \
+          "\0" * struct.calcsize(fiemap_extent)
+    try:
+        fd = os.open(f, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        try:
+            res = fcntl.ioctl(fd, FS_IOC_FIEMAP, req)
+        except IOError:
+            return None
+    finally:
+        os.close(fd)
+
+    mapped = struct.unpack_from(fiemap_head, res)[3]
+    if mapped == 0:
+        return None
+    return struct.unpack_from(fiemap_extent, res, struct.calcsize(fiemap_head))[1]
+
+def disk_location(f, extent=False):
+    """
+    Sort key placing file f near its neighbours on disk: by its first
+    physical extent (if extent, and one is reported), otherwise by
+    inode; files which can't be found sort last
+    """
+    try:
+        st = os.stat(f)
+    except OSError:
+        return (2,)
+
+    if extent:
+        physical = first_extent(f)
+        if physical is not None:
+            return (0, st.st_dev, physical)
+    return (1, st.st_dev, st.st_ino)
+
 def fnmatch_cpt(pathname,pattern):
     pathl = pathname.split(os.path.sep)
     pattl = pattern.split(os.path.sep)
@@ -144,6 +251,13 @@ def fixser(sno):
 pat_under = re.compile(r'[\s/^]')
 pat_removep = re.compile(r'[^A-Za-z0-9,.;:=%^&()_+-]')
 
+# precompiled element header layouts (tag, short VL, long VL) by byte order
+el_structs = {}
+for e in "<>":
+    el_structs[e] = (struct.Struct(e+"HH"), struct.Struct(e+"H"),
+                     struct.Struct(e+"I"))
+del e
+
 def tidy_protoname(desc):
     """
     Tidy protocol names/descriptions in a uniform way 
@@ -180,6 +294,9 @@ def string_escape_json(v):
             new += '\u%04x' % (ord(c),)
     return new
 
+def json_string(v):
+    return '"%s"' % string_escape_json(str(v))
+
 def value_to_json(v):
     if type(v) == str:
         return '"%s"' % string_escape_json(v)
@@ -196,8 +313,95 @@ class CSA:
     def __init__(self, d):
         self.d = d
 
+# Siemens CSA (SV10) layouts: header, field header, item sub-header
+csa_header = struct.Struct("<4s4sI4s")
+csa_field = struct.Struct("<64si4siii")
+csa_item = struct.Struct("<4i")
+
+class CSAIndex:
+    """
+    Siemens CSA header, indexed by field name.  A single pass over the
+    item sub-headers records where each field starts; item values are
+    only extracted for the fields asked for, so a large field such as
+    MrPhoenixProtocol is just stepped over.
+    """
+
+    def __init__(self, d):
+        self.d = d
+        self.fields = {}  # name -> offset of field header
+        self.names = []   # in file order
+        self.found = {}   # name -> values, as returned by values()
+
+        (magic, unused, n, unused) = csa_header.unpack_from(d, 0)
+        if magic != "SV10":
+            return
+
+        pos = csa_header.size
+        for i in range(0,n):
+            (name, vm, vr, syngodt, ni, unused) = csa_field.unpack_from(d, pos)
+            name = name[0:name.find("\0")]
+            if not name in self.fields:
+                self.names.append(name)
+            self.fields[name] = pos
+
+            pos += csa_field.size
+            for i in range(0,ni):
+                sublen = csa_item.unpack_from(d, pos)[1]
+                pos += csa_item.size + sublen + (4 - (sublen % 4)) % 4
+
+    def field(self, name):
+        """Decode one field, as {"vm", "vr", "syngodt", "nitems", "items"}"""
+        d = self.d
+        pos = self.fields[name]
+
+        (name, vm, vr, syngodt, ni, unused) = csa_field.unpack_from(d, pos)
+        pos += csa_field.size
+
+        items = []
+        for i in range(0,ni):
+            subhdr = csa_item.unpack_from(d, pos)
+            sublen = subhdr[1]
+            pos += csa_item.size
+
+            # value is NUL-terminated, then padded to a 4-byte multiple
+            val  = d[pos:pos+sublen]
+            vlen = val.find("\0")
+            val  = val[0:vlen].rstrip(" ")
+            items.append({"subhdr": subhdr, "val": val})
+            pos += sublen + (4 - (sublen % 4)) % 4
+
+        return {"vm": vm, "vr": vr.rstrip("\0"), "syngodt": syngodt,
+                "nitems": ni, "items": items}
+
+    def values(self, name):
+        """Values of the non-empty items of a field ([] if absent)"""
+        if not name in self.fields:
+            return []
+        if not name in self.found:
+            self.found[name] = [v["val"] for v in self.field(name)["items"]
+                                if v["subhdr"][0] > 0]
+        return list(self.found[name])
+
+# parsed CSA headers by content hash, most recently used last: series
+# headers, and often image headers, repeat byte-for-byte across files
+csa_memo = OrderedDict()
+csa_memo_max = 256
+
+def csa_index(d):
+    """CSAIndex for a CSA blob, shared with earlier identical blobs"""
+    key = hashlib.sha1(d).digest()
+    try:
+        index = csa_memo.pop(key)
+    except KeyError:
+        index = CSAIndex(d)
+        if len(csa_memo) >= csa_memo_max:
+            csa_memo.popitem(last=False)
+    csa_memo[key] = index
+    return index
+
 class DicomError(ValueError):
     def __init__(self,string,file):
+        ValueError.__init__(self,string,file) # keeps args, so it pickles
         self.err = string
         self.file = file
 
@@ -244,10 +448,138 @@ class DicomDict:
         dict.close()
         return self
 
+# maximum number of splits of a text value, by tag (-1 for no limit)
+text_splits = {}
+
+def decode_text(de, vl, vf, end):
+    # vf may be padded with space to even len...
+    vf = vf.rstrip()
+
+    # ...or with a NULL
+    if len(vf) > 1 and len(vf) % 2 == 0 and vf[-1] == "\x00":
+        vf = vf[0:-1]
+
+    # (this de-padding approach is rather simplistic)
+
+    try:
+        n = text_splits[de]
+    except KeyError:
+        mult = DicomDict().mult.get(de, "1").split("-")
+
+        def conv(x):
+            try:
+                return int(x)
+            except:
+                return "unlimited"
+
+        mult = [conv(x) for x in mult]
+
+        if len(mult)==1 and mult[0]==1:
+            n = 0
+        elif len(mult)==1 and mult[0]>1:
+            n = mult[0]-1
+        elif len(mult)>1 and mult[1]!="unlimited":
+            n = mult[1]-1
+        else: # unlimited
+            n = -1
+        text_splits[de] = n
+
+    if n == 0:
+        return (vf,)
+    return tuple(vf.split("\\", n))
+
+def decode_binary(code, size):
+    def decode(de, vl, vf, end):
+        return struct.unpack("%s%i%s" % (end, vl / size, code), vf)
+    return decode
+
+# value decoders, by VR
+vr_decoders = {}
+for vr in ("AE", "AS", "CS", "DA", "DS", "DT", "IS", "LO", "LT", "OB", "OW",
+           "PN", "SH", "ST", "TM", "UI", "UN", "UT"):
+    vr_decoders[vr] = decode_text
+for vr, code, size in (("AT", "H", 2), ("FL", "f", 4), ("FD", "d", 8),
+                       ("SL", "i", 4), ("SS", "h", 2), ("UL", "I", 4),
+                       ("US", "H", 2)):
+    vr_decoders[vr] = decode_binary(code, size)
+del vr, code, size
+
+def decode_value(de, vr, vl, vf, end, fn):
+    try:
+        decode = vr_decoders[vr]
+    except KeyError:
+        fields = "(0x%04x,0x%04x)" % (de[0], de[1])
+        raise DicomError("unknown VR %s in %s, giving up on file"%(vr,fields),fn)
+
+    vf = decode(de, vl, vf, end)
+    if len(vf)==1:
+        vf = vf[0]
+
+    return vf
+
+class RawValue(object):
+    """Undecoded element value, as read from the file"""
+    __slots__ = ("vr", "vl", "vf", "end")
+
+    def __init__(self, vr, vl, vf, end):
+        self.vr = vr
+        self.vl = vl
+        self.vf = vf
+        self.end = end
+
+class DicomValues(dict):
+    """
+    Element values by tag.  Values are stored as read and only decoded
+    (and the result kept) when they are first looked up, so elements
+    nobody asks for cost nothing beyond the read.
+    """
+
+    def __init__(self, fn=None):
+        dict.__init__(self)
+        self.fn = fn
+
+    def __getitem__(self, de):
+        vf = dict.__getitem__(self, de)
+        if isinstance(vf, RawValue):
+            # reported as readHeader would have, had it decoded the
+            # value then
+            try:
+                vf = decode_value(de, vf.vr, vf.vl, vf.vf, vf.end, self.fn)
+            except:
+                raise DicomError("failure reading header",self.fn)
+            dict.__setitem__(self, de, vf)
+        return vf
+
+    def get(self, de, default=None):
+        if de in self:
+            return self[de]
+        return default
+
+    def iteritems(self):
+        for de in self.keys():
+            yield de, self[de]
+
+    def itervalues(self):
+        for de in self.keys():
+            yield self[de]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        c = DicomValues(self.fn)
+        dict.update(c, self)
+        return c
+
 class DicomDataset:
 
-    def __init__(self):
-        self.__dict__['vals'] = {}
+    def __init__(self, vals=None):
+        if vals is None:
+            vals = DicomValues()
+        self.__dict__['vals'] = vals
         self.__dict__['dict'] = DicomDict()
 
     def gettag(self,tag):
@@ -300,12 +632,35 @@ class DicomDataset:
         except KeyError:
             raise AttributeError('No value for this DE')
 
+def acr_endian(prefix):
+    """
+    Guess whether a file starting with prefix is ACR-NEMA: its first
+    group should be a low one.  Returns the likely byte order, or None
+    """
+    if len(prefix) < 2:
+        return None
+
+    zero = struct.unpack('<H',prefix[:2])[0] # try little-endian
+
+    if zero == 0x0001 or zero == 0x0002 or zero == 0x0003 or zero == 0x0004 or \
+       zero == 0x0005 or zero == 0x0006 or zero == 0x0007 or zero == 0x0008:
+        return "<"
+
+    if zero == 0x0100 or zero == 0x0200 or zero == 0x0300 or zero == 0x0400 or \
+       zero == 0x0500 or zero == 0x0600 or zero == 0x0700 or zero == 0x0800:
+        return ">" # best guess: switch to big-endian
+
+    return None
+
 class DicomReader:
 
-    def __init__(self, filename, flat=False, sf=5, csa=1, acr=0):
+    def __init__(self, filename, flat=False, sf=5, csa=1, acr=0,
+            tags=None, stop=None, fh=None, head=""):
         self.dict = DicomDict()
         self.fn = filename
-        self.fh = file(self.fn, "rb")
+        if fh is None:
+            fh = file(self.fn, "rb")
+        self.fh = fh
         self.level = 0
         self.vals = {}
         self.flat = flat
@@ -313,28 +668,63 @@ class DicomReader:
         self.csa = csa # unused now
         self.acr = acr
 
+        # if given, only decode these elements (plus group 0002), and stop
+        # reading the top level after the stop element
+        self.tags = tags
+        self.stop = stop
+
+        # header bytes are read in bulk: buf holds the file from bufstart,
+        # and pos is the parse position in the file (head, if given, is
+        # the start of the file, already read from fh)
+        self.buf = head
+        self.bufstart = 0
+        self.pos = 0
+        self.chunk = 8192
+
         self.csadata = {}
 
+    def fill(self, n):
+        """Make n bytes from pos available in buf; returns count available"""
+        off = self.pos - self.bufstart
+        have = len(self.buf) - off
+        if have >= n:
+            return n
+
+        if off < 0 or have < 0:
+            # outside the buffer (skipped pixel data or a long value)
+            self.fh.seek(self.pos)
+            self.buf = self.fh.read(max(n, self.chunk))
+        else:
+            # keep the unparsed tail and read ahead, growing the read size
+            self.fh.seek(self.bufstart + len(self.buf))
+            self.buf = self.buf[off:] + self.fh.read(max(n - have, self.chunk))
+            self.chunk = min(self.chunk * 2, 1<<20)
+        self.bufstart = self.pos
+
+        return min(n, len(self.buf))
+
+    def read(self, n):
+        """Read n bytes (fewer at EOF) at pos, from the buffer"""
+        self.fill(n)
+        off = self.pos - self.bufstart
+        s = self.buf[off:off+n]
+        self.pos += len(s)
+        return s
+
     def checkType(self):
-        self.fh.seek(128)
-        prefix = self.fh.read(4)
+        self.pos = 0
+        self.fill(132)
+        self.pos = 128
+        prefix = self.read(4)
         return (prefix == "DICM")
 
     def checkACR(self):
-        self.fh.seek(0)
-        prefix = self.fh.read(2)
-        zero = struct.unpack('<H',prefix)[0] # try little-endian
-
-        if zero == 0x0001 or zero == 0x0002 or zero == 0x0003 or zero == 0x0004 or \
-           zero == 0x0005 or zero == 0x0006 or zero == 0x0007 or zero == 0x0008:
-            return 1
-
-        if zero == 0x0100 or zero == 0x0200 or zero == 0x0300 or zero == 0x0400 or \
-           zero == 0x0500 or zero == 0x0600 or zero == 0x0700 or zero == 0x0800:
-            self.end = ">" # best guess: switch to big-endian
-            return 1
-
-        return False
+        self.pos = 0
+        end = acr_endian(self.read(2))
+        if end is None:
+            return False
+        self.end = end
+        return 1
 
     def printin(self,str):
         sys.stdout.write (self.level * "    " + str)
@@ -355,14 +745,10 @@ class DicomReader:
             elif type == 'series':
                 vf = self.vals[(0x0029,0x1020)]
 
-            csa = self.convertCSA2(vf.d)
+            csa = csa_index(vf.d)
             self.csadata[type] = csa
 
-        try:
-            v = [v["val"] for v in csa[key]["items"] if v["subhdr"][0] > 0]
-            return v
-        except KeyError:
-            return []
+        return csa.values(key)
         
     def dumpCSA(self,csa,trunc=1):
         for k in csa.keys():
@@ -468,159 +854,22 @@ class DicomReader:
 
     def convertCSA2(self, str):
         csa = {}
-
-        v, str = unpack1("4s", str)
-        if v[0] != "SV10":
-            return {}
-        
-        # unused 4 bytes
-        v, str = unpack1("4s", str)
-
-        # number of fields
-        v, str = unpack1("<I", str)
-        n      = v[0]
-
-        # unused 4 bytes (77)
-        v, str = unpack1("4s", str)
-
-        for i in range(0,n):
-
-            # field name
-            v, str = unpack1("64s", str)
-            fnlen = v[0].find("\0")
-            name  = v[0][0:fnlen]
-            csa[name] = {}
-
-            # vm
-            v, str = unpack1("<i", str)
-            csa[name]["vm"] = v[0]
-
-            # vr
-            v, str = unpack1("4s", str)
-            csa[name]["vr"] = v[0].rstrip("\0")
-
-            # syngodt
-            v, str = unpack1("<i", str)
-            csa[name]["syngodt"] = v[0]
-            
-            # number of items within field
-            v, str = unpack1("<i", str)
-            ni = v[0]
-            
-            # unused 4 bytes (77)
-            v, str = unpack1("<i", str)
-
-            csa[name]["nitems"] = ni
-            csa[name]["items"] = [{} for i in range(0,ni)]
-
-            for i in range(0,ni):
-
-                # mysterious 16-byte "xx" sub-header
-                subhdr, str = unpack1("<4i", str)
-                sublen = subhdr[1]
-                csa[name]["items"][i]["subhdr"] = subhdr
-
-                # extract value and skip up to next 4-byte multiple
-                val   = str[0:sublen]
-                vlen  = val.find("\0")
-                val   = val[0:vlen].rstrip(" ")
-                csa[name]["items"][i]["val"] = val
-                nrem  = (4 - (sublen % 4)) % 4
-                str   = str[(sublen+nrem):]
-
+        index = CSAIndex(str)
+        for name in index.names:
+            csa[name] = index.field(name)
         return csa
 
     def convertVal(self, de, vr, vl, vf):
-        if   (vr == "AE"
-            or  vr == "AS"
-            or  vr == "CS"
-            or  vr == "DA"
-            or  vr == "DS"
-            or  vr == "DT"
-            or  vr == "IS"
-            or  vr == "LO"
-            or  vr == "LT"
-            or  vr == "OB"
-            or  vr == "OW"
-            or  vr == "PN"
-            or  vr == "SH"
-            or  vr == "ST"
-            or  vr == "TM"
-            or  vr == "UI"
-            or  vr == "UN"
-            or  vr == "UT"):
-
-            # vf may be padded with space to even len...
-            vf = vf.rstrip()
-
-            # ...or with a NULL
-            if len(vf) > 1 and len(vf) % 2 == 0 and vf[-1] == "\x00":
-                vf = vf[0:-1]
-
-            # (this de-padding approach is rather simplistic)
-
-            if de in self.dict.mult:
-                mult = self.dict.mult[de].split("-")
-            else:
-                mult = "1"
-
-            def conv(x):
-                try:
-                    return int(x)
-                except:
-                    return "unlimited"
-
-            mult = [conv(x) for x in mult]
-
-            if len(mult)==1 and mult[0]==1:
-                vf = [vf]
-            elif len(mult)==1 and mult[0]>1:
-                vf = vf.split("\\", mult[0]-1)
-            elif len(mult)>1 and mult[1]!="unlimited":
-                vf = vf.split("\\", mult[1]-1)
-            else: # unlimited
-                vf = vf.split("\\")
-
-            vf = tuple(vf)
-
-        elif  vr == "AT":
-            n  = vl / 2
-            vf = struct.unpack(self.end+"H"*n, vf)
-        elif  vr == "FL":
-            n  = vl / 4
-            vf = struct.unpack(self.end+"f"*n, vf)
-        elif  vr == "FD":
-            n  = vl / 8
-            vf = struct.unpack(self.end+"d"*n, vf)
-        elif  vr == "SL":
-            n  = vl / 4
-            vf = struct.unpack(self.end+"i"*n, vf)
-        elif  vr == "SS":
-            n  = vl / 2
-            vf = struct.unpack(self.end+"h"*n, vf)
-        elif  vr == "UL":
-            n  = vl / 4
-            vf = struct.unpack(self.end+"I"*n, vf)
-        elif  vr == "US":
-            n  = vl / 2
-            vf = struct.unpack(self.end+"H"*n, vf)
-        else:
-            fields = "(0x%04x,0x%04x)" % (de[0], de[1])
-            raise DicomError("unknown VR %s in %s, giving up on file"%(vr,fields),self.fn)
-
-        if len(vf)==1:
-            vf = vf[0]
-
-        return vf
+        return decode_value(de, vr, vl, vf, self.end, self.fn)
 
     def readHeader(self):
 
         if self.checkType():
-            self.fh.seek(132)
+            self.pos = 132
             implicit=0
 
         elif self.acr and self.checkACR():
-            self.fh.seek(0)
+            self.pos = 0
             implicit=1
 
         else:
@@ -635,14 +884,17 @@ class DicomReader:
             raise DicomError("failure reading header",self.fn)
         return self
 
+    def dataset(self):
+        return DicomDataset(self.vals)
+
     def readFields(self, maxbytes=0, implicit=0):
-        myvals = {}
-        startb = self.fh.tell()
+        myvals = DicomValues(self.fn)
+        startb = self.pos
         switch_endian = 0
         switch_implicit = 0
         switch_at = 0
         while 1:
-            value_start = self.fh.tell()
+            value_start = self.pos
 
             if switch_endian and value_start >= switch_at:
                 self.end = ">"
@@ -655,24 +907,33 @@ class DicomReader:
             if maxbytes > 0 and value_start >= startb+maxbytes:
                 break
 
-            de = self.fh.read(4)   # data element
+            # tag and the short form of VR/VL are always there
+            have = self.fill(8)
 
             # check for EOF
-            if de == "":
+            if have == 0:
                 break
+            elif have < 8:
+                raise DicomError("truncated element",self.fn)
+
+            tag_s, short_s, long_s = el_structs[self.end]
+            off = value_start - self.bufstart
 
-            # unpack DE and construct hex representation
-            de = struct.unpack(self.end+"HH", de)
-            dehex = ["%04x" % x for x in de]
+            # unpack DE
+            de = tag_s.unpack_from(self.buf, off)
+
+            # past the last element we were asked for
+            if self.stop is not None and self.level == 0 and de > self.stop:
+                break
 
             # implicit end of sequence code
             if de == (0xfffe, 0xe0dd):
-                self.fh.read(4)    # value length (should be zero)
+                self.pos += 8    # value length (should be zero)
                 break
 
             # other implicit sequence codes
             if de[0] == 0xfffe:
-                self.fh.read(4)    # value length (should be zero)
+                self.pos += 8    # value length (should be zero)
                 continue
 
             if implicit:
@@ -681,85 +942,835 @@ class DicomReader:
                 else:
                     vr = 'UN'
 
-                vl = struct.unpack(self.end+"I", self.fh.read(4))[0]
-                vltype = "Long"
+                vl = long_s.unpack_from(self.buf, off+4)[0]
+                self.pos += 8
 
             else:
 
-                vr = self.fh.read(2)   # value representation
-                tmp = struct.unpack(self.end+"H", self.fh.read(2))[0]
+                vr = self.buf[off+4:off+6]   # value representation
 
                 # read length, according to VR
                 if vr == "OB" or vr == "OW" or vr == "SQ" or vr == "UN":
-                    vl = struct.unpack(self.end+"I", self.fh.read(4))[0]
-                    vltype = "Long"
+                    if self.fill(12) < 12:
+                        raise DicomError("truncated element",self.fn)
+                    off = value_start - self.bufstart
+                    vl = long_s.unpack_from(self.buf, off+8)[0]
+                    self.pos += 12
                 else:
-                    vl = tmp
-                    vltype = "Short"
+                    vl = short_s.unpack_from(self.buf, off+6)[0]
+                    self.pos += 8
+
+            # skip unwanted values; sequences of unknown length still have
+            # to be walked to find their end, and flattened ones may
+            # contain wanted elements
+            wanted = self.tags is None or de in self.tags or de[0] == 0x0002
+            if not wanted and vl != 0xFFFFFFFF and \
+                    not (self.flat and vr == "SQ"):
+                self.pos += vl
+                continue
 
-            # simply skip if unknown VR
-            if vr == None:
-                self.fh.seek(vl, 1)
+            # recurse if sequence VR
+            if vr == "SQ" or vl == 0xFFFFFFFF:
+                if vl > 0:
+                    self.level += 1
+                    vf = self.readFields(maxbytes=vl,implicit=implicit)
+                    if self.flat:
+                        myvals.update(vf) # still undecoded
+                        vf = "(flattened)"
+                    self.level -= 1
+                else:
+                    pass
 
+            # otherwise read VF
             else:
 
-                # recurse if sequence VR
-                if vr == "SQ" or vl == 0xFFFFFFFF:
-                    if vl > 0:
-                        self.level += 1
-                        vf = self.readFields(maxbytes=vl,implicit=implicit)
-                        if self.flat:
-                            for de2 in vf.keys():
-                                myvals[de2] = vf[de2]
-                            vf = "(flattened)"
-                        self.level -= 1
+                # for pixel data element, store location and length
+                if de == (0x7fe0, 0x0010):
+                    vf = (self.pos, vl)
+                    self.pos += vl
+
+                elif de == (0x0029, 0x1010):
+                    vf = CSA(self.read(vl))
+                    
+                elif de == (0x0029, 0x1020):
+                    vf = CSA(self.read(vl))
+
+                # group 0002 is needed to carry on parsing
+                elif de[0] == 0x0002:
+                    vf = self.read(vl)
+                    try:
+                        vf = self.convertVal(de, vr, vl, vf)
+                    except:
+                        raise DicomError("VR error, giving up on file %s",self.fn)
+
+                # everything else is decoded on first use
+                else:
+                    vf = RawValue(vr, vl, self.read(vl), self.end)
+
+
+                if de == (0x0002, 0x0000):
+                    switch_at = value_start + vf
+
+                # check transfer syntax
+                if de == (0x0002, 0x0010):
+                    if   vf == "1.2.840.10008.1.2": # implicit LE
+                        switch_implicit = 1
+                    elif   vf == "1.2.840.10008.1.2.1": # explicit LE
+                        switch_endian = 0
+                    elif vf == "1.2.840.10008.1.2.2": # explicit BE
+                        switch_endian = 1
                     else:
-                        pass
+                        raise DicomError("unhandled TS %s, giving up on file"%(repr(vf),),self.fn)
+
+            if wanted:
+                myvals[de] = vf
+
+            if de == self.stop and self.level == 0:
+                break
+
+        # end: while 1
+        return myvals
+
+class Entity:
+    def __repr__(self):
+        return pprint.pformat(self.__dict__)
+
+class DicomSliceScanner:
+    """
+    Per-file half of DicomSequenceReader.scanAll: reads one header and
+    extracts a compact record for each slice it holds (one per tile for
+    mosaics).  Records depend only on the file itself, so they can be
+    built in any order, or in worker processes; everything which
+    depends on other files is left to the merge in scanAll.
+
+    Files are sniffed before a reader is made for them: those which
+    can't be DICOM (or ACR-NEMA, with acr), or are smaller than minsize,
+    are turned away after one small read (or a stat, for size), and
+    scanFile returns just the reason as a string.
+    """
+
+    # elements used by readSlice; the rest of the header is skipped
+    tags = set([
+        (0x0008,0x0008), (0x0008,0x0020), (0x0008,0x0021), (0x0008,0x0022),
+        (0x0008,0x0030), (0x0008,0x0031), (0x0008,0x0032), (0x0008,0x1030),
+        (0x0008,0x103e), (0x0010,0x0010), (0x0010,0x4000), (0x0018,0x0020),
+        (0x0018,0x0022), (0x0018,0x0023), (0x0018,0x0050), (0x0018,0x0080),
+        (0x0018,0x0081), (0x0018,0x0086), (0x0018,0x0087), (0x0018,0x0088),
+        (0x0018,0x1030), (0x0018,0x1312), (0x0018,0x1314), (0x0018,0x1315),
+        (0x0018,0x1316), (0x0019,0x100c), (0x0019,0x100e), (0x0019,0x1014),
+        (0x0020,0x000d), (0x0020,0x0011), (0x0020,0x0013), (0x0020,0x0032),
+        (0x0020,0x0037), (0x0020,0x0100), (0x0020,0x1041), (0x0020,0x4000),
+        (0x0028,0x0010), (0x0028,0x0011), (0x0028,0x0030), (0x0028,0x0100),
+        (0x0028,0x0103),
+        (0x0028,0x1052), (0x0028,0x1053), (0x0029,0x1010), (0x0029,0x1020),
+        (0x7fe0,0x0010),
+    ])
+
+    # sniff's reason for a file it couldn't open or read: unlike the
+    # others, this may pass, so isn't kept in the scan cache
+    unreadable = "unreadable file"
+
+    def __init__(self, flat=False, csa=1, acr=0, mosaic=None, slice3d=False,
+            sliceinst=False, stackunk=False, sar=False, phase=False,
+            minsize=0):
+        self.flat = flat
+        self.csa = csa
+        self.acr = acr
+        self.mosaic = mosaic
+        self.slice3d = slice3d
+        self.sliceinst = sliceinst
+        self.stackunk = stackunk
+        self.sar = sar
+        self.phase = phase
+        self.minsize = minsize
+
+    def sniff(self, f):
+        """
+        Open f and read its first block: returns (fh, head) if it may be
+        DICOM, otherwise the reason it was rejected
+        """
+
+        # small files aren't even opened
+        if self.minsize:
+            try:
+                if os.stat(f).st_size < self.minsize:
+                    return "smaller than --min-size"
+            except OSError:
+                return self.unreadable
+
+        # (eg listed by --files-from, but gone since, or a directory)
+        try:
+            fh = file(f, "rb")
+        except EnvironmentError:
+            return self.unreadable
+
+        # one read, the size the reader would start with anyway
+        try:
+            head = fh.read(8192)
+        except EnvironmentError:
+            fh.close()
+            return self.unreadable
+        if head[128:132] == "DICM":
+            return fh, head
+        if self.acr and acr_endian(head) is not None:
+            return fh, head
+
+        fh.close()
+        if self.acr:
+            return "not a DICOM or (probably) ACR file"
+        return "not a DICOM file"
+
+    def scanFile(self, f):
+        """
+        return a list of slice records, or a string if the file was
+        rejected by sniff; failures are recorded in .error
+        """
+
+        sniffed = self.sniff(f)
+        if isinstance(sniffed, str):
+            return sniffed
+        fh, head = sniffed
+
+        try:
+            d = DicomReader(f,self.flat,5,self.csa,self.acr,
+                            self.tags,(0x7fe0,0x0010),fh,head).readHeader()
+        except DicomError, e:
+            rec = self.newRecord(f)
+            rec.error = e
+            return [rec]
+
+        slices = []
+        seen = 0
+        while 1:
+            rec = self.newRecord(f)
+            try:
+                self.readSlice(d, f, seen, rec)
+            except DicomError, e:
+                rec.error = e
+            slices.append(rec)
+
+            # mosaics yield one record per tile
+            if rec.error is not None or rec.nmos is None or seen+1 >= rec.nmos:
+                break
+            seen += 1
+
+        return slices
+
+    def signature(self):
+        """options which change the records built by scanFile"""
+        return (self.flat, self.csa, self.acr, self.mosaic, self.slice3d,
+                self.sliceinst, self.stackunk, self.sar, self.phase,
+                self.minsize)
+
+    def newRecord(self, f):
+        rec = Entity()
+        rec.file = f
+        rec.error = None
+        rec.study = None
+        rec.xdesc = None
+        rec.image_type = None
+        rec.nmos = None
+        rec.warnings = []
+        return rec
+
+    def readSlice(self, d, f, seen, rec):
+        """
+        Fill rec with the fields of tile number 'seen' (0 unless mosaic).
+        Fields needed to filter the file are stored as soon as they are
+        known, so the filters still work if a later field is missing.
+        """
+
+        ws = re.compile(r' ')
+        warnings = rec.warnings
+        instance_time = 0
+
+        try:
+
+            # start with biographical/seq data for filtering
+            try:
+                # study  = d.vals[0x0020,0x0010]
+                study  = d.vals[0x0020,0x000D]
+            except KeyError:
+                study  = "anon"
+            
+            try:
+                name   = d.vals[0x0010,0x0010]
+            except KeyError:
+                name = "anon"
+
+            rec.study = study
+            rec.name = name
+
+            try:
+                echo  = int(d.vals[0x0018,0x0086])
+            except KeyError:
+                echo  = 1
+            
+            try:
+                te  = float(d.vals[0x0018,0x0081])
+            except (KeyError, ValueError):
+                te  = 0.0
+
+            try:
+                tr  = float(d.vals[0x0018,0x0080])
+            except (KeyError, ValueError):
+                tr  = 0.0
+            
+            try:
+                flip  = float(d.vals[0x0018,0x1314])
+            except (KeyError, ValueError):
+                flip  = 0.0
+
+            try:
+                vflip  = d.vals[0x0018,0x1315]
+            except (KeyError, ValueError):
+                vflip  = 'N'
+
+            try:
+                xdesc   = d.vals[0x0008,0x103e]
+            except KeyError:
+                try:
+                    xdesc   = d.vals[0x0018,0x1030]
+                except KeyError:
+                    try:
+                        xdesc   = d.vals[0x0008,0x1030]
+                    except:
+                        xdesc   = "unknown"
+
+            # desc exclusions are run by scanAll before any failure below
+            rec.xdesc = xdesc
+
+            try:
+                image_cmt = d.vals[0x0020,0x4000]
+            except KeyError:
+                image_cmt = None
+
+            try:
+                patient_cmt = d.vals[0x0010,0x4000]
+            except KeyError:
+                patient_cmt = None
+
+            # whole image type
+            xtype   = "/".join(d.vals[0x0008,0x0008])
+
+            # modality-specific type, used to modify the sequence name
+            image_type = d.vals[0x0008,0x0008]
+            if len(image_type) > 2:
+                ximtype = ws.subn('_', image_type[2])[0].lower()
+            else:
+                ximtype = ''
+
+            # and type exclusions next
+            rec.image_type = image_type
 
-                # otherwise read VF
+            # extract some useful parameters
+            try:
+                ser    = d.vals[0x0020,0x0011]
+            except KeyError:
+                ser    = "0"
+
+            # one broken GE dataset needed this...
+            ser    = ser.lstrip(' ')
+            rec.ser = ser
+
+            no_geometry = False
+            if not(d.vals.has_key( (0x0020,0x0032) ) and
+                    d.vals.has_key( (0x0020,0x0037) )):
+                if self.stackunk or self.sliceinst:
+                    no_geometry = True
+                    warnings.append(DicomError("unknown geometry, using naive stacking", f))
                 else:
+                    raise DicomError("no geometry, no --stack-unk, skipping file", f)
+
+            if self.slice3d:
+                pos = [float(x) for x in d.vals[0x0020,0x0032]]
+                orn = [float(x) for x in d.vals[0x0020,0x0037]]
+                k = [
+                        orn[1]*orn[5] - orn[2]*orn[4],
+                        orn[2]*orn[3] - orn[0]*orn[5],
+                        orn[0]*orn[4] - orn[1]*orn[3],
+                    ]
+                slice = "%f" % (k[0]*pos[0] + k[1]*pos[1] + k[2]*pos[2],)
+                sliced = d.vals[0x0020,0x0032]
+            elif self.sliceinst or no_geometry:
+                sliced = ["0.0", "0.0", str(float(d.vals[0x0020,0x0013]))]
+                slice = sliced[2]
+            else:
+                try:
+                    slice  = d.vals[0x0020,0x1041]  # orthogonal slice location
+                    sliced  = d.vals[0x0020,0x0032] # 3D location
+                except KeyError:
+                    slice = d.vals[0x0020,0x0032][2] # last elt of 3D slice position (may fail)
+                    sliced = d.vals[0x0020,0x0032]   # 3D location
 
-                    # for pixel data element, store location and length
-                    if de == (0x7fe0, 0x0010):
-                        vf = (self.fh.tell(), vl)
-                        self.fh.seek(vl, 1)
+            try:
+                instance = int(d.vals[0x0020,0x0013])
+            except KeyError:
+                instance = 1
+                warnings.append(DicomError("missing instance number, assuming 1", f))
 
-                    elif de == (0x0029, 0x1010):
-                        vf = CSA(self.fh.read(vl))
-                    
-                    elif de == (0x0029, 0x1020):
-                        vf = CSA(self.fh.read(vl))
+            # dtimes = d.vals[0x0020,0x0105]
+            try:
+                time   = d.vals[0x0020,0x0100]
+            except KeyError:
+                try:
+                    time = d.vals[0x0020,0x0013] # instance number
+                    instance_time = 1
+                except KeyError:
+                    time   = "0"
+
+            rows   = d.vals[0x0028,0x0010]
+            cols   = d.vals[0x0028,0x0011]
+            bits   = d.vals[0x0028,0x0100]
+
+            # pixel representation 0 is unsigned; without it, assume
+            # signed as volconv always has
+            try:
+                signed = d.vals[0x0028,0x0103] != 0
+            except KeyError:
+                signed = True
+
+            if not bits in (8, 16, 32):
+                raise DicomError("unsupported bits allocated (%s), skipping file"%(bits,), f)
+            pixtype = "%s%i" % (("u","i")[signed], bits / 8)
 
+            try:
+                res    = \
+                    [float(x) for x in (d.vals[0x0028,0x0030] + (d.vals[0x0018,0x0088],))]
+            except KeyError:
+                try:
+                    res    = \
+                        [float(x) for x in (d.vals[0x0028,0x0030] + (d.vals[0x0018,0x0050],))]
+                except ValueError:
+                    res = \
+                        [float(x) for x in (d.vals[0x0028,0x0030] + ("1",))]
+                    warnings.append(DicomError("unknown slice thickness, assuming 1mm", f))
+                except KeyError:
+                    res = [1.0, 1.0, 1.0]
+                    warnings.append(DicomError("unknown resolution, assuming 1x1x1mm", f))
+
+
+            # find a date - we prefer a study date (fixed for the whole study) over
+            # a series-specific date (unless the study spans midnight...)
+            try:
+                xdate   = d.vals[0x0008,0x0020] # study date
+                if int(xdate) == 0: raise KeyError
+            except KeyError:
+                try:
+                    xdate   = d.vals[0x0008,0x0021] # series date
+                    if int(xdate) == 0: raise KeyError
+                except KeyError:
+                    try:
+                        xdate   = d.vals[0x0008,0x0022] # acquisition date
+                    except KeyError:
+                        xdate = "00000000"
+
+            # find a series time - we prefer a series time, if possible
+            try:
+                xtime   = d.vals[0x0008,0x0031] # series
+            except KeyError:
+                try:
+                    xtime   = d.vals[0x0008,0x0030] # study
+                except KeyError:
+                    xtime   = "0000"
+
+            try:
+                study_time   = d.vals[0x0008,0x0030] # study
+            except:
+                study_time = "0000"
+
+            try:
+                study_date   = d.vals[0x0008,0x0020] # study date
+                if int(study_date) == 0: raise KeyError
+            except:
+                study_date = "00000000"
+
+            # store the acquisition time (seems to vary hugely: on some scanners it's
+            # the series time, some it's the volume time, and some it's the actual
+            # slice time within a multi-slice sequence)
+            try:
+                dtime   = d.vals[0x0008,0x0032] # acquisition
+            except KeyError:
+                dtime   = xtime # copy series/study time
+
+            if self.sliceinst or no_geometry:
+                orientt  = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+            else:
+                orientt  = tuple([float(x) for x in d.vals[0x0020,0x0037]])
+
+            try:
+                intercept = float(d.vals[0x0028,0x1052])
+                slope     = float(d.vals[0x0028,0x1053])
+            except KeyError:
+                intercept = 0.0
+                slope     = 1.0
+
+            # table position
+            try:
+                table = [int(e) for e in d.vals[0x0019,0x1014].split('\\')]
+            except KeyError:
+                table = None
+
+            # actual pixel data
+            pixels = d.vals[0x7fe0,0x0010]
+
+            mosaicid = None
+
+            # forced mosaic size
+            if self.mosaic:
+                mosaic = [self.mosaic]
+
+            # definative check (forces CSA "image" parse, which is slow)
+            elif self.csa:
+                mosaic = d.getCSA("image", "NumberOfImagesInMosaic")
+            
+            # attempt fast check
+            else:
+                try:
+                    s = d.vals[0x0008,0x0008]
+                    if ' '.join(s).upper().find("MOSAIC") != -1:
+                        mosaic = d.getCSA("image", "NumberOfImagesInMosaic")
                     else:
-                        vf = self.fh.read(vl)
+                        mosaic = []
+                except KeyError:
+                    mosaic = []
+
+            # StartFMRI "images" appear to have all the CSA headers of the real thing, but with
+            # a small dummy image; so you don't _really_ want to try and unpack them as mosaics
+            # Check for this by looking for "DUMMY IMAGE" in the type string; this doesn't
+            if mosaic != []:
+                s = d.vals[0x0008,0x0008]
+                if ' '.join(s).upper().find("DUMMY IMAGE") != -1:
+                    mosaic = []
+                    warnings.append(
+                            DicomError("not unpacking mosaic for dummy image", f))
+            
+            # Siemens diffusion direction; this will be a function of time
+            # for Siemens at least, this is in the DICOM patient co-ordinate system
+            try:
+                if self.csa:
+                    diff = [float(x) for x in d.getCSA("image","DiffusionGradientDirection")]
+                else:
+                    diff = d.vals[0x0019,0x100e]
+
+                    # this should be a float vector, but when LEI images are sent PACS->3T->physics
+                    # group 19 becomes entirely "UN" VRs, so it's garbage.  Typically we'll have
+                    # the CSA header already by this point for mosaics, so use that instead.
+                    if type(diff) == str:
                         try:
-                            vf = self.convertVal(de, vr, vl, vf)
+                            diff = [float(x) for x in d.getCSA("image","DiffusionGradientDirection")]
+                            warnings.append(
+                                    DicomError("diffusion vector has bad type, using CSA instead", f))
                         except:
-                            raise DicomError("VR error, giving up on file %s",self.fn)
+                            diff = []
+                            warnings.append(
+                                    DicomError("diffusion vector has bad type, no CSA available", f))
+            except KeyError:
+                diff = []
+
+            # SAR
+            if self.sar:
+                sar_values        = d.getCSA("series","SARMostCriticalAspect")
+                sar_body_pred     = d.vals[0x0018,0x1316]
+                sar_most_crit     = d.getCSA("series","RFSWDMostCriticalAspect")
+                sar_mode          = d.getCSA("series","RFSWDOperationMode")
+                sar = {
+                        "values": [float(x) for x in sar_values],
+                        "body":   float(sar_body_pred),
+                        "most_crit": sar_most_crit[0],
+                        "mode": int(sar_mode[0]),
+                        }
+            else:
+                sar = None
+
+            # Phase encode direction
+            if self.phase:
+                phase_direction     = d.vals[0x0018,0x1312]
+                phase_positive      = int(d.getCSA("image","PhaseEncodingDirectionPositive")[0])
+
+                if phase_direction == "ROW":
+                    phase_axis = "i"
+                elif phase_direction == "COL":
+                    phase_axis = "j"
+
+                if phase_positive == 0:
+                    phase_axis = "-" + phase_axis
+
+                phase = {
+                        "direction":    phase_direction,
+                        "positive":     phase_positive,
+                        "axis":         phase_axis,
+                        }
+            else:
+                phase = None
 
+            # B value
+            try:
+                if self.csa:
+                    bval = float(d.getCSA("image","B_value")[0])
+                else:
+                    bval = float(d.vals[0x0019,0x100c])
+            except KeyError:
+                bval = None
+
+            if mosaic != []:
+                nmos = int(mosaic[0])
+                rec.nmos = nmos
+
+                # warn the user (once per file), this is guessed-from-data code
+                if seen == 0:
+                    warnings.append(
+                        DicomError("mosiac is not standards-based, beware geometry", f))
+
+                # actual image matrix
+                fac = math.ceil(math.sqrt(nmos))
+                mrows = rows
+                mcols = cols
+                rows = mrows / fac
+                cols = mcols / fac
+
+                # row and column co-ordinates of this slice
+                rpos = int(seen) / int(fac)
+                cpos = int(seen) % int(fac)
+
+                # find normal vector
+                k = [0.0, 0.0, 0.0]
+                i = orientt[0:3]
+                j = orientt[3:]
+                k[0] = i[1]*j[2] - i[2]*j[1]
+                k[1] = i[2]*j[0] - i[0]*j[2]
+                k[2] = i[0]*j[1] - i[1]*j[0]
+
+                # calculate position of actual first slice (not top of mosaic)
+                truepos = [0.0, 0.0, 0.0]
+                colcor = (float(mcols) - float(cols))/2.0
+                rowcor = (float(mrows) - float(rows))/2.0
+                truepos[0] = float(sliced[0]) + i[0]*res[0]*colcor + j[0]*res[1]*rowcor
+                truepos[1] = float(sliced[1]) + i[1]*res[0]*colcor + j[1]*res[1]*rowcor
+                truepos[2] = float(sliced[2]) + i[2]*res[0]*colcor + j[2]*res[1]*rowcor
+
+                # calculate position of *this* slice
+                fseen = float(seen)
+                spacing = float(d.vals[0x0018,0x0088])
+                slice = str(float(slice) + spacing * fseen)
+                sliced = (
+                    truepos[0] + k[0] * spacing * fseen,
+                    truepos[1] + k[1] * spacing * fseen,
+                    truepos[2] + k[2] * spacing * fseen,
+                )
+
+                # store information for unpacking mosaic element
+                mosaicid = Entity()
+                mosaicid.mrows = mrows
+                mosaicid.mcols = mcols
+                mosaicid.n = seen
+                mosaicid.rpos = rpos
+                mosaicid.cpos = cpos
+
+            # Mosaic images:
+            # - calculate and store image region
+            # - update rows, columns, and image position (how?)
+            # - one record per tile (scanFile asks for each in turn)
+            # - possibly do some orientation-related magic (what?)
+
+        except KeyError, e:
+            fields = "(0x%04x,0x%04x)" % (e[0][0], e[0][1])
+            raise DicomError("missing element %s, skipping file"%(fields,), f)
+
+        # SPM8 and SPM12 write special desc fields; 
+        # look for "descrip = " in the SPM source. For example:
+        # "3T 3D RM TR=22.5ms/TE=11.2ms/FA=20deg/SO=no 01-Dec-2012 12:01:01.123"
 
-                    if de == (0x0002, 0x0000):
-                        switch_at = value_start + vf
+        try:
+            scanoptions = str(d.vals[0x0018,0x0022])
+            if scanoptions == "":
+                scanoptions = "no"
+        except KeyError:
+            scanoptions = "no"
 
-                    # check transfer syntax
-                    if de == (0x0002, 0x0010):
-                        if   vf == "1.2.840.10008.1.2": # implicit LE
-                            switch_implicit = 1
-                        elif   vf == "1.2.840.10008.1.2.1": # explicit LE
-                            switch_endian = 0
-                        elif vf == "1.2.840.10008.1.2.2": # explicit BE
-                            switch_endian = 1
-                        else:
-                            raise DicomError("unhandled TS %s, giving up on file"%(repr(vf),),self.fn)
+        if "MOSAIC" in d.vals[0x0008,0x0008]:
+            mosaic = " Mosaic"
+        else:
+            mosaic = ""
 
-                myvals[de] = vf
+        # AcquisitionTime can be different for different slices
+        # (eg with a 2D acquisition) so must be store per s/t/e
+        #
+        # (this runs before the description and type filters, so an
+        # unparseable date or time must not stop the whole scan)
 
-        # end: while 1
-        return myvals
+        try:
+            adate = d.vals[0x0008,0x0022] # AcquisitionTime
+            atime = d.vals[0x0008,0x0032] # AcquisitionDate
+
+            dt = datetime.strptime(adate,"%Y%m%d")
+
+            m = re.match(r'(\d{2})(\d{2})([0-9\.]+)$',atime)
+            time_hr = m.group(1)
+            time_mn = m.group(2)
+            time_sc = m.group(3)
+
+            descrip = '%gT %s %s TR=%gms/TE=%gms/FA=%gdeg/SO=%s %s %s:%s:%.5g%s' % \
+            (
+                float(d.vals[0x0018,0x0087]), # MagneticFieldStrength
+                str(d.vals[0x0018,0x0023]), # MRAcquisitionType
+                re.sub(r'\s+','', str(d.vals[0x0018,0x0020])), # ScanningSequence
+                float(tr),
+                float(te),
+                float(flip),
+                scanoptions,
+                dt.strftime("%m-%b-%Y"),
+                time_hr,
+                time_mn,
+                float(time_sc),
+                mosaic,
+            )
+        except (KeyError, ValueError, AttributeError):
+            descrip = "missing"
+
+        rec.echo = echo
+        rec.te = te
+        rec.tr = tr
+        rec.flip = flip
+        rec.vflip = vflip
+        rec.image_cmt = image_cmt
+        rec.patient_cmt = patient_cmt
+        rec.xtype = xtype
+        rec.ximtype = ximtype
+        rec.no_geometry = no_geometry
+        rec.slice = slice
+        rec.sliced = sliced
+        rec.instance = instance
+        rec.time = time
+        rec.instance_time = instance_time
+        rec.rows = rows
+        rec.cols = cols
+        rec.res = res
+        rec.xdate = xdate
+        rec.xtime = xtime
+        rec.study_time = study_time
+        rec.study_date = study_date
+        rec.dtime = dtime
+        rec.orientt = orientt
+        rec.intercept = intercept
+        rec.slope = slope
+        rec.table = table
+        rec.end = d.end
+        rec.pixtype = pixtype
+        rec.pixels = pixels
+        rec.mosaicid = mosaicid
+        rec.diff = diff
+        rec.sar = sar
+        rec.phase = phase
+        rec.bval = bval
+        rec.descrip = descrip
+
+class DicomScanCacheBusy(EnvironmentError):
+    """The scan cache is open in another run"""
+    pass
+
+class DicomScanCache:
+    """
+    Persistent store of DicomSliceScanner.scanFile results, keyed by
+    absolute path and scanner options, and only trusted while the file
+    keeps the same size and mtime.  Files which aren't DICOM are stored
+    too, so they needn't be probed again on the next run; files which
+    couldn't be read at all are not, as that may be passing.
+
+    The store (usually dbm, or dumbdbm) has no locking of its own, so
+    only one run may have a cache open at once: another gets
+    DicomScanCacheBusy rather than waiting.
+    """
+
+    # bump whenever the slice records change shape
+    version = 4
+
+    def __init__(self, path, scanner):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.lockfh = open(os.path.join(path, "volconv-scan.lock"), "w")
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.lockfh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self.lockfh.close()
+                raise DicomScanCacheBusy("scan cache %s is in use by another run" % path)
+
+        self.db = shelve.open(os.path.join(path, "volconv-scan"), protocol=2)
+        self.prefix = repr((self.version, scanner.signature())) + ":"
+        self.hits = 0
+
+        # looked up from the scan pool's feeder thread (see scanFiles)
+        self.lock = threading.Lock()
+
+    def stamp(self, f):
+        try:
+            st = os.stat(f)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def get(self, f, stamp):
+        if stamp is None:
+            return None
+
+        try:
+            self.lock.acquire()
+            try:
+                saved, slices = self.db[self.prefix + os.path.abspath(f)]
+            finally:
+                self.lock.release()
+        except KeyError:
+            return None
+
+        if saved != stamp:
+            return None
+
+        # rejected by DicomSliceScanner.sniff: only the reason is kept
+        if isinstance(slices, str):
+            self.hits += 1
+            return slices
+
+        # the file may have been reached by a different relative path
+        for rec in slices:
+            rec.file = f
+            if rec.error is not None:
+                rec.error.file = f
+            for w in rec.warnings:
+                w.file = f
+
+        self.hits += 1
+        return slices
+
+    def put(self, f, stamp, slices):
+        if slices == DicomSliceScanner.unreadable:
+            return
+        if stamp is not None:
+            self.lock.acquire()
+            try:
+                self.db[self.prefix + os.path.abspath(f)] = (stamp, slices)
+            finally:
+                self.lock.release()
+
+    def close(self):
+        self.db.close()
+        self.lockfh.close()
+
+# worker process state for parallel scanning (see DicomSequenceReader.scanFiles)
+scan_worker_scanner = None
+
+def scan_worker_init(scanner):
+    global scan_worker_scanner
+    scan_worker_scanner = scanner
+
+def scan_worker(f):
+    return scan_worker_scanner.scanFile(f)
 
-class Entity:
-    def __repr__(self):
-        return pprint.pformat(self.__dict__)
 
 class DicomSequenceReader:
 
@@ -768,9 +1779,12 @@ class DicomSequenceReader:
             mosaic=None, slice3d=False, sliceinst=False, stackunk=False, sar=False, phase=False,
             fnmatch=None, fnmatch_relative=False, roundorient=True, roundorientthresh=0.2,
             nsubseries=False,
-            typeinc='', typeexc=''):
+            typeinc='', typeexc='', jobs=1, cache=None, prune='', maxdepth=None,
+            filesfrom=None, nullsep=False, minsize=0, readorder="listed"):
     
         self.files = []
+        self.found = 0
+        self.walked = False
         self.csa = csa
         self.acr = acr
         self.splitorient = splitorient
@@ -793,32 +1807,19 @@ class DicomSequenceReader:
         else:
             self.pattern = re.compile(pattern)
         self.fnmatch = fnmatch
-        
-        def extendby(basepath,dirname,names):
-            if not fnmatch is None:
-                if fnmatch_relative:
-                    pfnmatch = os.path.join(basepath,self.fnmatch)
-                else:
-                    pfnmatch = self.fnmatch
-            else:
-                pfnmatch = None
+        self.fnmatch_relative = fnmatch_relative
+
+        if prune == "":
+            self.prune = None
+        else:
+            self.prune = re.compile(prune)
+        self.maxdepth = maxdepth
 
-            for x in names:
-                px = os.path.join(dirname,x)
-                if not os.path.isdir(px):
-                    if (pfnmatch is None) or fnmatch_cpt(px,pfnmatch):
-                        if (self.pattern is None) or self.pattern.search(px):
-                            self.files.extend([px])
+        self.filesfrom = filesfrom
+        self.nullsep = nullsep
 
-        for path in paths:
-            if os.path.isdir(path):
-                os.path.walk(path,extendby,path)
-            else:
-                self.files.append(path)
-        
-        ## this is neater, but os.walk isn't available in Python 2.2
-        #for pn in os.walk(path):
-        #    self.files.extend([(pn[0]+os.sep+x) for x in pn[2]])
+        # files to scan are found as they are scanned (see discover)
+        self.paths = paths
 
         self.seqinc = re.compile(seqinc)
         if seqexc != '':
@@ -833,67 +1834,334 @@ class DicomSequenceReader:
         self.timehack = timehack
         self.show_error_eg = True
 
+        self.jobs = jobs
+        self.readorder = readorder
+        self.scanner = DicomSliceScanner(flat=flat, csa=csa, acr=acr,
+                mosaic=mosaic, slice3d=slice3d, sliceinst=sliceinst,
+                stackunk=stackunk, sar=sar, phase=phase, minsize=minsize)
+
+        self.cache = None
+        if cache is not None:
+            try:
+                self.cache = DicomScanCache(cache, self.scanner)
+            except DicomScanCacheBusy, e:
+                puts("Warning: %s; not using it\n" % (e,))
+
     def dumpStudies(self):
         pprint.pprint(self.studies)
 
+    def walkFiles(self):
+        """
+        Generate the files under self.paths which match --pattern and
+        --fnmatch, in the order os.path.walk visits them; directories
+        matching --prune, or deeper than --max-depth, are skipped.  Then
+        the files listed by --files-from.  Without the optional scandir
+        module, telling files from directories takes a stat per entry
+        (see list_dir)
+        """
+        for path in self.paths:
+            if not os.path.isdir(path):
+                yield path
+                continue
+
+            if self.fnmatch is None:
+                pfnmatch = None
+            elif self.fnmatch_relative:
+                pfnmatch = os.path.join(path,self.fnmatch)
+            else:
+                pfnmatch = self.fnmatch
+
+            dirs = [(path, 0)]
+            while dirs:
+                subdirs = []
+                dirname, depth = dirs.pop()
+                for px, kind in list_dir(dirname):
+                    if kind == 'dir':
+                        # pruned subtrees are never even listed
+                        if self.maxdepth is not None and depth >= self.maxdepth:
+                            continue
+                        if self.prune is not None and self.prune.search(px):
+                            continue
+                        subdirs.append((px, depth + 1))
+                    elif kind == 'file':
+                        if self.wanted(px,pfnmatch):
+                            yield px
+
+                # depth first, each directory's files before its subdirectories
+                subdirs.reverse()
+                dirs.extend(subdirs)
+
+        if self.filesfrom is not None:
+            for px in self.listedFiles():
+                if self.wanted(px,self.fnmatch):
+                    yield px
+
+    def wanted(self, px, pfnmatch):
+        if (pfnmatch is None) or fnmatch_cpt(px,pfnmatch):
+            if (self.pattern is None) or self.pattern.search(px):
+                return True
+        return False
+
+    def listedFiles(self):
+        """
+        Generate the names in the --files-from list, as they are read;
+        separated by newlines, or NULs with --null
+        """
+        if self.filesfrom == "-":
+            fh = sys.stdin
+        else:
+            fh = open(self.filesfrom, 'rb')
+
+        if self.nullsep:
+            sep = '\0'
+        else:
+            sep = '\n'
+
+        # the last name of each block may continue in the next
+        rest = ''
+        while True:
+            data = fh.read(65536)
+            names = (rest + data).split(sep)
+            if data:
+                rest = names.pop()
+            for px in names:
+                if not self.nullsep:
+                    px = px.rstrip('\r')
+                if px != '':
+                    yield px
+            if not data:
+                break
+
+        if fh is not sys.stdin:
+            fh.close()
+
+    def discover(self):
+        """
+        Generate the files to scan, collecting them in self.files.  The
+        tree is walked by a thread a bounded way ahead, so scanning can
+        start straight away
+        """
+        found = Queue.Queue(10000)
+        failed = []
+
+        def walk():
+            try:
+                try:
+                    for f in self.walkFiles():
+                        found.put(f)
+                        self.found += 1
+                except Exception:
+                    failed.append(sys.exc_info())
+            finally:
+                self.walked = True
+                found.put(None)
+
+        walker = threading.Thread(target=walk)
+        walker.daemon = True
+        walker.start()
+
+        while True:
+            f = found.get()
+            if f is None:
+                break
+            self.files.append(f)
+            yield f
+
+        if failed:
+            raise failed[0][0], failed[0][1], failed[0][2]
+
+    def scanFiles(self):
+        """
+        Generate the list of slice records for each file, in file order,
+        taking them from the scan cache where possible
+        """
+
+        files = self.discover()
+
+        if self.cache is None:
+            for slices in self.readFiles(files):
+                yield slices
+            return
+
+        # each file is looked up as it is found, and only those not in
+        # the cache are read.  Lookups happen as the reader takes files
+        # (in the pool's feeder thread, with jobs > 1), and reading on a
+        # thread of its own; both queue what they have, and signal, so
+        # each file is handed on as soon as it's at the head of the list
+        listed = collections.deque()
+        results = collections.deque()
+        ready = threading.Condition()
+        finished = []
+        failed = []
+
+        def signal(queue, item):
+            ready.acquire()
+            try:
+                queue.append(item)
+                ready.notify()
+            finally:
+                ready.release()
+
+        def uncached():
+            for f in files:
+                stamp = self.cache.stamp(f)
+                slices = self.cache.get(f, stamp)
+                signal(listed, (f, stamp, slices))
+                if slices is None:
+                    yield f
+
+        def read():
+            try:
+                try:
+                    for slices in self.readFiles(uncached()):
+                        signal(results, slices)
+                except Exception:
+                    failed.append(sys.exc_info())
+            finally:
+                signal(finished, True)
+
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+
+        while True:
+            ready.acquire()
+            try:
+                while not finished and not (listed and
+                        (listed[0][2] is not None or results)):
+                    ready.wait()
+
+                if listed and listed[0][2] is not None:
+                    f, stamp, slices = listed.popleft()
+                    stamp = None
+                elif listed and results:
+                    f, stamp, slices = listed.popleft()
+                    slices = results.popleft()
+                else:
+                    break
+            finally:
+                ready.release()
+
+            if stamp is not None:
+                self.cache.put(f, stamp, slices)
+            yield slices
+
+        if failed:
+            raise failed[0][0], failed[0][1], failed[0][2]
+
+    def readFiles(self, files):
+        """
+        Generate the list of slice records for each file, in file order.
+        With a read order other than "listed", all the files are found
+        first, then read in order of their location on disk (by inode,
+        or first extent); the records are still generated in file order
+        """
+
+        if self.readorder == "listed":
+            for slices in self.readBatch(files):
+                yield slices
+            return
+
+        files = list(files)
+        extent = (self.readorder == "extent")
+        order = [(disk_location(f, extent), i) for i, f in enumerate(files)]
+        order.sort()
+        order = [i for key, i in order]
+
+        # hold each file's records until those of the files listed
+        # before it are ready
+        results = [None] * len(files)
+        done = 0
+        scanned = self.readBatch([files[i] for i in order])
+        for i, slices in itertools.izip(order, scanned):
+            results[i] = slices
+            while done < len(files) and results[done] is not None:
+                yield results[done]
+                results[done] = None
+                done += 1
+
+    def readBatch(self, files):
+        """
+        Generate the list of slice records for each file, in the order
+        given; with jobs > 1, headers are read by a pool of worker
+        processes
+        """
+
+        if self.jobs <= 1:
+            for f in files:
+                yield self.scanner.scanFile(f)
+            return
+
+        import multiprocessing
+
+        # big enough chunks to amortize the IPC, small enough to balance
+        # (files are still being found, so their number isn't known)
+        chunk = 16
+
+        pool = multiprocessing.Pool(self.jobs, scan_worker_init, (self.scanner,))
+        try:
+            for slices in pool.imap(scan_worker, files, chunk):
+                yield slices
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
     def scanAll(self):
         self.studies  = {}
 
-        n = -1
-        repeat = 0
-        total = len(self.files)
+        n = 0
         self.seriescount = 0
         errors = {}
-        visited = {}
+        rejects = {}
         orientations = {}
         warnings = []
         errcount = 0
-        ws = re.compile(r' ')
         single_study = None
         single_name = None
         single_ser = None
         single = self.single
 
-        while 1:
-
-            read_header = 0
-            
-            if not repeat:
-                n += 1
-                read_header = 1
-
-            if n == len(self.files):
-                break
+        # Merge the slice records from each file, strictly in file order
+        #
+        # -- everything here may depend on what has been seen already,
+        # so output is the same however (and in whatever order) the
+        # headers themselves were read
 
-            f = self.files[n]
+        for slices in self.scanFiles():
+            n += 1
 
-          # if not self.pattern.search(f): continue
+            # turned away by DicomSliceScanner.sniff: just count them,
+            # keeping the first as an example (and a place in errors,
+            # so warnings are listed as they'd be otherwise)
+            if isinstance(slices, str):
+                errcount += 1
+                if not rejects.has_key(slices):
+                    rejects[slices] = [0, self.files[n-1]]
+                    errors.setdefault(slices, [])
+                rejects[slices][0] += 1
+                continue
 
-          # if not self.fnmatch is None:
-          #     if not fnmatch_cpt(f,self.fnmatch): continue
+            for rec in slices:
+                f = rec.file
+                warnings = rec.warnings
 
-            repeat = 0
-            warnings=[]
-            instance_time = 0
-            try:
-                if read_header:
-                    d = DicomReader(f,self.flat,5,self.csa,self.acr).readHeader()
+                try:
 
-                puts("\rReading: %i/%i (%i warning%s)  "%(n+1,total,errcount,plural(errcount)))
+                    # header unreadable, or not DICOM at all, or failed
+                    # before the description filters could be run
+                    if rec.study is None or \
+                            (rec.error is not None and rec.xdesc is None):
+                        raise rec.error
 
-                try:
+                    # the total isn't known until every file is found
+                    if self.walked:
+                        puts("\rReading: %i/%i (%i warning%s)  "%(n,self.found,errcount,plural(errcount)))
+                    else:
+                        puts("\rReading: %i (%i warning%s)  "%(n,errcount,plural(errcount)))
 
-                    # start with biographical/seq data for filtering
-                    try:
-                        # study  = d.vals[0x0020,0x0010]
-                        study  = d.vals[0x0020,0x000D]
-                    except KeyError:
-                        study  = "anon"
-                    
-                    try:
-                        name   = d.vals[0x0010,0x0010]
-                    except KeyError:
-                        name = "anon"
+                    study = rec.study
+                    name = rec.name
 
                     if single_study == None:
                         single_study = study
@@ -904,85 +2172,28 @@ class DicomSequenceReader:
                     if single:
                         name = single_name + "_S"
                         study = single_study + "_S"
-                   
-                    try:
-                        echo  = int(d.vals[0x0018,0x0086])
-                    except KeyError:
-                        echo  = 1
-                    
-                    try:
-                        te  = float(d.vals[0x0018,0x0081])
-                    except (KeyError, ValueError):
-                        te  = 0.0
-
-                    try:
-                        tr  = float(d.vals[0x0018,0x0080])
-                    except (KeyError, ValueError):
-                        tr  = 0.0
-                    
-                    try:
-                        flip  = float(d.vals[0x0018,0x1314])
-                    except (KeyError, ValueError):
-                        flip  = 0.0
-
-                    try:
-                        vflip  = d.vals[0x0018,0x1315]
-                    except (KeyError, ValueError):
-                        vflip  = 'N'
 
-                    try:
-                        xdesc   = d.vals[0x0008,0x103e]
-                    except KeyError:
-                        try:
-                            xdesc   = d.vals[0x0018,0x1030]
-                        except KeyError:
-                            try:
-                                xdesc   = d.vals[0x0008,0x1030]
-                            except:
-                                xdesc   = "unknown"
-                
-                    # run desc exclusions before we try other parameters (which might fail)
-                    if not self.seqinc.search(xdesc):
+                    # run desc exclusions before we report other parameters (which might have failed)
+                    if not self.seqinc.search(rec.xdesc):
                         raise DicomError("description didn't match include pattern, skipping file", f)
                     
-                    if self.seqexc != None and self.seqexc.search(xdesc):
+                    if self.seqexc != None and self.seqexc.search(rec.xdesc):
                         raise DicomError("description matched exclude pattern, skipping file", f)
 
-                    try:
-                        image_cmt = d.vals[0x0020,0x4000]
-                    except KeyError:
-                        image_cmt = None
-
-                    try:
-                        patient_cmt = d.vals[0x0010,0x4000]
-                    except KeyError:
-                        patient_cmt = None
-
-                    # whole image type
-                    xtype   = "/".join(d.vals[0x0008,0x0008])
-
-                    # modality-specific type, used to modify the sequence name
-                    image_type = d.vals[0x0008,0x0008]
-                    if len(image_type) > 2:
-                        ximtype = ws.subn('_', image_type[2])[0].lower()
-                    else:
-                        ximtype = ''
-
                     # run type exclusions next
-                    if self.typeinc != "" and (not self.typeinc.upper() in [e.upper() for e in image_type]):
-                        raise DicomError("type didn't match include value, skipping file", f)
-                    
-                    if self.typeexc != "" and (self.typeexc.upper() in [e.upper() for e in image_type]):
-                        raise DicomError("type matched exclude value, skipping file", f)
+                    if rec.image_type is not None:
+                        image_type = rec.image_type
 
-                    # extract some useful parameters
-                    try:
-                        ser    = d.vals[0x0020,0x0011]
-                    except KeyError:
-                        ser    = "0"
+                        if self.typeinc != "" and (not self.typeinc.upper() in [e.upper() for e in image_type]):
+                            raise DicomError("type didn't match include value, skipping file", f)
+                        
+                        if self.typeexc != "" and (self.typeexc.upper() in [e.upper() for e in image_type]):
+                            raise DicomError("type matched exclude value, skipping file", f)
+
+                    if rec.error is not None:
+                        raise rec.error
 
-                    # one broken GE dataset needed this...
-                    ser    = ser.lstrip(' ')
+                    ser = rec.ser
 
                     if single_ser == None:
                         single_ser = ser
@@ -990,539 +2201,194 @@ class DicomSequenceReader:
                     if single:
                         ser = single_ser + "S"
 
-                    no_geometry = False
-                    if not(d.vals.has_key( (0x0020,0x0032) ) and
-                            d.vals.has_key( (0x0020,0x0037) )):
-                        if self.stackunk or self.sliceinst:
-                            no_geometry = True
-                            warnings.append(DicomError("unknown geometry, using naive stacking", f))
-                        else:
-                            raise DicomError("no geometry, no --stack-unk, skipping file", f)
-
-                    if self.slice3d:
-                        pos = [float(x) for x in d.vals[0x0020,0x0032]]
-                        orn = [float(x) for x in d.vals[0x0020,0x0037]]
-                        k = [
-                                orn[1]*orn[5] - orn[2]*orn[4],
-                                orn[2]*orn[3] - orn[0]*orn[5],
-                                orn[0]*orn[4] - orn[1]*orn[3],
-                            ]
-                        slice = "%f" % (k[0]*pos[0] + k[1]*pos[1] + k[2]*pos[2],)
-                        sliced = d.vals[0x0020,0x0032]
-                    elif self.sliceinst or no_geometry:
-                        sliced = ["0.0", "0.0", str(float(d.vals[0x0020,0x0013]))]
-                        slice = sliced[2]
-                    else:
-                        try:
-                            slice  = d.vals[0x0020,0x1041]  # orthogonal slice location
-                            sliced  = d.vals[0x0020,0x0032] # 3D location
-                        except KeyError:
-                            slice = d.vals[0x0020,0x0032][2] # last elt of 3D slice position (may fail)
-                            sliced = d.vals[0x0020,0x0032]   # 3D location
-
-                    try:
-                        instance = int(d.vals[0x0020,0x0013])
-                    except KeyError:
-                        instance = 1
-                        warnings.append(DicomError("missing instance number, assuming 1", f))
-
-                    # dtimes = d.vals[0x0020,0x0105]
-                    try:
-                        time   = d.vals[0x0020,0x0100]
-                    except KeyError:
-                        try:
-                            time = d.vals[0x0020,0x0013] # instance number
-                            instance_time = 1
-                        except KeyError:
-                            time   = "0"
-
-                    rows   = d.vals[0x0028,0x0010]
-                    cols   = d.vals[0x0028,0x0011]
-                    bytes  = d.vals[0x0028,0x0100] / 8
-
-                    try:
-                        res    = \
-                            [float(x) for x in (d.vals[0x0028,0x0030] + (d.vals[0x0018,0x0088],))]
-                    except KeyError:
-                        try:
-                            res    = \
-                                [float(x) for x in (d.vals[0x0028,0x0030] + (d.vals[0x0018,0x0050],))]
-                        except ValueError:
-                            res = \
-                                [float(x) for x in (d.vals[0x0028,0x0030] + ("1",))]
-                            warnings.append(DicomError("unknown slice thickness, assuming 1mm", f))
-                        except KeyError:
-                            res = [1.0, 1.0, 1.0]
-                            warnings.append(DicomError("unknown resolution, assuming 1x1x1mm", f))
-
-
-                    # find a date - we prefer a study date (fixed for the whole study) over
-                    # a series-specific date (unless the study spans midnight...)
-                    try:
-                        xdate   = d.vals[0x0008,0x0020] # study date
-                        if int(xdate) == 0: raise KeyError
-                    except KeyError:
-                        try:
-                            xdate   = d.vals[0x0008,0x0021] # series date
-                            if int(xdate) == 0: raise KeyError
-                        except KeyError:
-                            try:
-                                xdate   = d.vals[0x0008,0x0022] # acquisition date
-                            except KeyError:
-                                xdate = "00000000"
-
-                    # find a series time - we prefer a series time, if possible
-                    try:
-                        xtime   = d.vals[0x0008,0x0031] # series
-                    except KeyError:
-                        try:
-                            xtime   = d.vals[0x0008,0x0030] # study
-                        except KeyError:
-                            xtime   = "0000"
-
-                    try:
-                        study_time   = d.vals[0x0008,0x0030] # study
-                    except:
-                        study_time = "0000"
-
-                    try:
-                        study_date   = d.vals[0x0008,0x0020] # study date
-                        if int(study_date) == 0: raise KeyError
-                    except:
-                        study_date = "00000000"
-
-                    # store the acquisition time (seems to vary hugely: on some scanners it's
-                    # the series time, some it's the volume time, and some it's the actual
-                    # slice time within a multi-slice sequence)
-                    try:
-                        dtime   = d.vals[0x0008,0x0032] # acquisition
-                    except KeyError:
-                        dtime   = xtime # copy series/study time
-
-                    if self.sliceinst or no_geometry:
-                        orientt  = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
-                    else:
-                        orientt  = tuple([float(x) for x in d.vals[0x0020,0x0037]])
-
-                    try:
-                        intercept = float(d.vals[0x0028,0x1052])
-                        slope     = float(d.vals[0x0028,0x1053])
-                    except KeyError:
-                        intercept = 0.0
-                        slope     = 1.0
-
-                    # table position
-                    try:
-                        table = [int(e) for e in d.vals[0x0019,0x1014].split('\\')]
-                    except KeyError:
-                        table = None
-
-                    # actual pixel data
-                    pixels = d.vals[0x7fe0,0x0010]
-
-                    mosaicid = None
-
-                    # forced mosaic size
-                    if self.mosaic:
-                        mosaic = [self.mosaic]
-
-                    # definative check (forces CSA "image" parse, which is slow)
-                    elif self.csa:
-                        mosaic = d.getCSA("image", "NumberOfImagesInMosaic")
-                    
-                    # attempt fast check
-                    else:
-                        try:
-                            s = d.vals[0x0008,0x0008]
-                            if ' '.join(s).upper().find("MOSAIC") != -1:
-                                mosaic = d.getCSA("image", "NumberOfImagesInMosaic")
-                            else:
-                                mosaic = []
-                        except KeyError:
-                            mosaic = []
-
-                    # StartFMRI "images" appear to have all the CSA headers of the real thing, but with
-                    # a small dummy image; so you don't _really_ want to try and unpack them as mosaics
-                    # Check for this by looking for "DUMMY IMAGE" in the type string; this doesn't
-                    if mosaic != []:
-                        s = d.vals[0x0008,0x0008]
-                        if ' '.join(s).upper().find("DUMMY IMAGE") != -1:
-                            mosaic = []
-                            warnings.append(
-                                    DicomError("not unpacking mosaic for dummy image", f))
-                    
-                    # Siemens diffusion direction; this will be a function of time
-                    # for Siemens at least, this is in the DICOM patient co-ordinate system
-                    try:
-                        if self.csa:
-                            diff = [float(x) for x in d.getCSA("image","DiffusionGradientDirection")]
-                        else:
-                            diff = d.vals[0x0019,0x100e]
-
-                            # this should be a float vector, but when LEI images are sent PACS->3T->physics
-                            # group 19 becomes entirely "UN" VRs, so it's garbage.  Typically we'll have
-                            # the CSA header already by this point for mosaics, so use that instead.
-                            if type(diff) == str:
-                                try:
-                                    diff = [float(x) for x in d.getCSA("image","DiffusionGradientDirection")]
-                                    warnings.append(
-                                            DicomError("diffusion vector has bad type, using CSA instead", f))
-                                except:
-                                    diff = []
-                                    warnings.append(
-                                            DicomError("diffusion vector has bad type, no CSA available", f))
-                    except KeyError:
-                        diff = []
-
-                    # SAR
-                    if self.sar:
-                        sar_values        = d.getCSA("series","SARMostCriticalAspect")
-                        sar_body_pred     = d.vals[0x0018,0x1316]
-                        sar_most_crit     = d.getCSA("series","RFSWDMostCriticalAspect")
-                        sar_mode          = d.getCSA("series","RFSWDOperationMode")
-                        sar = {
-                                "values": [float(x) for x in sar_values],
-                                "body":   float(sar_body_pred),
-                                "most_crit": sar_most_crit[0],
-                                "mode": int(sar_mode[0]),
-                                }
-                    else:
-                        sar = None
-
-                    # Phase encode direction
-                    if self.phase:
-                        phase_direction     = d.vals[0x0018,0x1312]
-                        phase_positive      = int(d.getCSA("image","PhaseEncodingDirectionPositive")[0])
-
-                        if phase_direction == "ROW":
-                            phase_axis = "i"
-                        elif phase_direction == "COL":
-                            phase_axis = "j"
-
-                        if phase_positive == 0:
-                            phase_axis = "-" + phase_axis
-
-                        phase = {
-                                "direction":    phase_direction,
-                                "positive":     phase_positive,
-                                "axis":         phase_axis,
-                                }
-                    else:
-                        phase = None
-
-                    # B value
-                    try:
-                        if self.csa:
-                            bval = float(d.getCSA("image","B_value")[0])
-                        else:
-                            bval = float(d.vals[0x0019,0x100c])
-                    except KeyError:
-                        bval = None
-
-                    if mosaic != []:
-                        nmos = int(mosaic[0])
-
-                        # get visit count
-                        try:
-                            seen = visited[f]
-                        except KeyError:
-
-                            # warn the user, this is guessed-from-data code
-                            warnings.append(
-                                DicomError("mosiac is not standards-based, beware geometry", f))
-
-                            visited[f] = 0
-                            seen = 0
+                    orientt = rec.orientt
+                    ximtype = rec.ximtype
+                    echo = rec.echo
+                    time = rec.time
 
-                        # do we need to visit again?
-                        if (seen+1) < nmos:
-                            repeat = 1
+                    if not (study, name) in self.studies:
+                        self.studies[study, name] = {}
 
-                        # update visit count
-                        visited[f] = visited[f] + 1
-                        
-                        # actual image matrix
-                        fac = math.ceil(math.sqrt(nmos))
-                        mrows = rows
-                        mcols = cols
-                        rows = mrows / fac
-                        cols = mcols / fac
-
-                        # row and column co-ordinates of this slice
-                        rpos = int(seen) / int(fac)
-                        cpos = int(seen) % int(fac)
-
-                        # find normal vector
-                        k = [0.0, 0.0, 0.0]
-                        i = orientt[0:3]
-                        j = orientt[3:]
-                        k[0] = i[1]*j[2] - i[2]*j[1]
-                        k[1] = i[2]*j[0] - i[0]*j[2]
-                        k[2] = i[0]*j[1] - i[1]*j[0]
-
-                        # calculate position of actual first slice (not top of mosaic)
-                        truepos = [0.0, 0.0, 0.0]
-                        colcor = (float(mcols) - float(cols))/2.0
-                        rowcor = (float(mrows) - float(rows))/2.0
-                        truepos[0] = float(sliced[0]) + i[0]*res[0]*colcor + j[0]*res[1]*rowcor
-                        truepos[1] = float(sliced[1]) + i[1]*res[0]*colcor + j[1]*res[1]*rowcor
-                        truepos[2] = float(sliced[2]) + i[2]*res[0]*colcor + j[2]*res[1]*rowcor
-
-                        # calculate position of *this* slice
-                        fseen = float(seen)
-                        spacing = float(d.vals[0x0018,0x0088])
-                        slice = str(float(slice) + spacing * fseen)
-                        sliced = (
-                            truepos[0] + k[0] * spacing * fseen,
-                            truepos[1] + k[1] * spacing * fseen,
-                            truepos[2] + k[2] * spacing * fseen,
-                        )
-
-                        # store information for unpacking mosaic element
-                        mosaicid = Entity()
-                        mosaicid.mrows = mrows
-                        mosaicid.mcols = mcols
-                        mosaicid.n = seen
-                        mosaicid.rpos = rpos
-                        mosaicid.cpos = cpos
-
-                    # Mosaic images:
-                    # - calculate and store image region
-                    # - update rows, columns, and image position (how?)
-                    # - put file back on the list if needed
-                    # - possibly do some orientation-related magic (what?)
-
-                except KeyError, e:
-                    fields = "(0x%04x,0x%04x)" % (e[0][0], e[0][1])
-                    raise DicomError("missing element %s, skipping file"%(fields,), f)
-
-                if not (study, name) in self.studies:
-                    self.studies[study, name] = {}
-
-                v = self.studies[study, name]
+                    v = self.studies[study, name]
                
-                if not (study, name) in orientations.keys():
-                    orientations[study,name] = {}
-                if not ser in orientations[study,name].keys():
-                    orientations[study,name][ser] = {}
-
-                if self.roundorient:
-                    close_enough = None
-                    n_close_enough = 0
-                    n_nearly_close_enough = 0
-
-                    # Find any known orientation that's close enough to the current one
-                    #
-                    # -- note that the behaviour of this strategy when several
-                    # slices have nearly-close-enough orientations becomes
-                    # potentially dependent on the order the files are read, in
-                    # two ways.  When a second just-about-distinct known
-                    # orientation is added, other slices may fall within the
-                    # rounding error of both, so their assignment can depend on
-                    # whether they are read before or after it.  And as further
-                    # slices are assigned, the lower_exact value may change,
-                    # which might affect which other slices fall within range.
-                    #
-                    # -- in this edge case, we can't know a priori whether the
-                    # user really wanted the volumes split or not, so if this
-                    # happens, the user will just need to adjust
-                    # --round-threshold up or down to get what they wanted.
-                    #
-                    # -- but to help the user notice that it's happened, we
-                    # check for two warning flags: orientations marked as
-                    # different but within double the threshold, and slices
-                    # which could be assigned to more than one volume.
-                    #
-                    # -- we never want to merge orientations for which the image
-                    # types are different (messes up GE vol+projection series)
-
-                    for known, known_imtype in orientations[study,name][ser].keys():
-                        a1, a2 = angle(orientt,known)
-
-                        if known_imtype != ximtype:
-                            continue
-
-                        if a1 < self.roundorientthresh and a2 < self.roundorientthresh:
-                            close_enough = known
-                            n_close_enough += 1
-
-                        if a1 < self.roundorientthresh*2.0 and a2 < self.roundorientthresh*2.0:
-                            n_nearly_close_enough += 1
-
-                        if n_nearly_close_enough > n_close_enough:
-                            warnings.append(
-                                    DicomError("orientation merge had near miss (< 2*threshold)", f))
-
-                    if close_enough is not None:
-                        old_exact = close_enough
-                        new_exact = orientt
+                    if not (study, name) in orientations.keys():
+                        orientations[study,name] = {}
+                    if not ser in orientations[study,name].keys():
+                        orientations[study,name][ser] = {}
+
+                    if self.roundorient:
+                        close_enough = None
+                        n_close_enough = 0
+                        n_nearly_close_enough = 0
+
+                        # Find any known orientation that's close enough to the current one
+                        #
+                        # -- note that the behaviour of this strategy when several
+                        # slices have nearly-close-enough orientations becomes
+                        # potentially dependent on the order the files are read, in
+                        # two ways.  When a second just-about-distinct known
+                        # orientation is added, other slices may fall within the
+                        # rounding error of both, so their assignment can depend on
+                        # whether they are read before or after it.  And as further
+                        # slices are assigned, the lower_exact value may change,
+                        # which might affect which other slices fall within range.
+                        #
+                        # -- in this edge case, we can't know a priori whether the
+                        # user really wanted the volumes split or not, so if this
+                        # happens, the user will just need to adjust
+                        # --round-threshold up or down to get what they wanted.
+                        #
+                        # -- but to help the user notice that it's happened, we
+                        # check for two warning flags: orientations marked as
+                        # different but within double the threshold, and slices
+                        # which could be assigned to more than one volume.
+                        #
+                        # -- we never want to merge orientations for which the image
+                        # types are different (messes up GE vol+projection series)
+
+                        for known, known_imtype in orientations[study,name][ser].keys():
+                            a1, a2 = angle(orientt,known)
+
+                            if known_imtype != ximtype:
+                                continue
+
+                            if a1 < self.roundorientthresh and a2 < self.roundorientthresh:
+                                close_enough = known
+                                n_close_enough += 1
+
+                            if a1 < self.roundorientthresh*2.0 and a2 < self.roundorientthresh*2.0:
+                                n_nearly_close_enough += 1
+
+                            if n_nearly_close_enough > n_close_enough:
+                                warnings.append(
+                                        DicomError("orientation merge had near miss (< 2*threshold)", f))
+
+                        if close_enough is not None:
+                            old_exact = close_enough
+                            new_exact = orientt
                         
-                        if n_close_enough > 1:
-                            warnings.append(
-                                    DicomError("orientation merge slice assignment is ambiguous", f))
-
-                        if old_exact != new_exact:
-                            lower_exact = lowest(old_exact, new_exact)
-
-                            orientt = lower_exact
-
-                            suff = orientations[study,name][ser][old_exact,ximtype]
-                            del orientations[study,name][ser][old_exact,ximtype]
-                            orientations[study,name][ser][lower_exact,ximtype] = suff
-
-                def suffix(n):
-                    if n == 0:
-                        return ''
-                    else:
-                        return 'o%d' % (n,)
-
-                if self.splitorient:
-                    if no_geometry:
-                        sersuff = 'unk'
-                    elif orientations[study,name][ser].has_key((orientt,ximtype)):
-                        sersuff = orientations[study,name][ser][orientt,ximtype]
-                    else:
-                        sersuff = suffix(len(orientations[study,name][ser]))
-
-                    orientations[study,name][ser][orientt,ximtype] = sersuff
-                    ser = ser + sersuff
-
-                # updates to v[ser] must happen *after* sersuff has been added
-                if self.roundorient and \
-                   close_enough is not None and \
-                   old_exact != new_exact:
+                            if n_close_enough > 1:
+                                warnings.append(
+                                        DicomError("orientation merge slice assignment is ambiguous", f))
 
-                        del v[ser].orient[old_exact]
-                        v[ser].orient[lower_exact] = True
+                            if old_exact != new_exact:
+                                lower_exact = lowest(old_exact, new_exact)
 
-                # SPM8 and SPM12 write special desc fields; 
-                # look for "descrip = " in the SPM source. For example:
-                # "3T 3D RM TR=22.5ms/TE=11.2ms/FA=20deg/SO=no 01-Dec-2012 12:01:01.123"
+                                orientt = lower_exact
 
-                try:
-                    scanoptions = str(d.vals[0x0018,0x0022])
-                    if scanoptions == "":
-                        scanoptions = "no"
-                except KeyError:
-                    scanoptions = "no"
-
-                if "MOSAIC" in d.vals[0x0008,0x0008]:
-                    mosaic = " Mosaic"
-                else:
-                    mosaic = ""
+                                suff = orientations[study,name][ser][old_exact,ximtype]
+                                del orientations[study,name][ser][old_exact,ximtype]
+                                orientations[study,name][ser][lower_exact,ximtype] = suff
 
-                adate = d.vals[0x0008,0x0022] # AcquisitionTime
-                atime = d.vals[0x0008,0x0032] # AcquisitionDate
-
-                # AcquisitionTime can be different for different slices
-                # (eg with a 2D acquisition) so must be store per s/t/e
-
-                dt = datetime.strptime(adate,"%Y%m%d")
-
-                m = re.match(r'(\d{2})(\d{2})([0-9\.]+)$',atime)
-                time_hr = m.group(1)
-                time_mn = m.group(2)
-                time_sc = m.group(3)
+                    def suffix(n):
+                        if n == 0:
+                            return ''
+                        else:
+                            return 'o%d' % (n,)
 
-                try:
-                    descrip = '%gT %s %s TR=%gms/TE=%gms/FA=%gdeg/SO=%s %s %s:%s:%.5g%s' % \
-                    (
-                        float(d.vals[0x0018,0x0087]), # MagneticFieldStrength
-                        str(d.vals[0x0018,0x0023]), # MRAcquisitionType
-                        re.sub(r'\s+','', str(d.vals[0x0018,0x0020])), # ScanningSequence
-                        float(tr),
-                        float(te),
-                        float(flip),
-                        scanoptions,
-                        dt.strftime("%m-%b-%Y"),
-                        time_hr,
-                        time_mn,
-                        float(time_sc),
-                        mosaic,
-                    )
-                except KeyError:
-                    descrip = "missing"
-                
-                if not ser in v:
-                    v[ser] = Entity()
-                    v[ser].echoes = {}
-                    v[ser].te     = {}
-                    v[ser].slices = {}
-                    v[ser].slicesd = {}
-                    v[ser].times  = {} # normally from instance numbers
-                    v[ser].dtimes = {} # dynamic time (per-ser, per-vol, or per-slice)
-                    v[ser].file   = {}
-                    v[ser].end    = {}
-                    v[ser].pixels = {}
-                    v[ser].rescale = {}
-                    v[ser].mosaic = {}
-                    v[ser].diff   = {}
-                    v[ser].bval   = {}
-                    v[ser].descrip = {}
-                    v[ser].shape  = (cols, rows)
-                    v[ser].res    = res
-                    v[ser].desc   = xdesc
-                    v[ser].type   = xtype
-                    v[ser].date   = xdate # study/series date
-                    v[ser].time   = xtime # series/study time
-                    v[ser].stdate = study_date
-                    v[ser].sttime = study_time
-                    v[ser].sar    = sar
-                    v[ser].phase  = phase
-                    v[ser].imtype = ximtype
-                    v[ser].tr     = tr
-                    v[ser].flip   = flip
-                    v[ser].vflip  = vflip
-                    v[ser].table  = table
-                    v[ser].instance_time = instance_time
-                    v[ser].patient_cmt = patient_cmt
-                    v[ser].image_cmt = image_cmt
-                    v[ser].instance = instance
-                    self.seriescount += 1
-                    v[ser].orient = {}
-
-                # this allows us to catenate multiple orientations
-                # (in which case we will ignore orientation data!)
-                # (these will, of course, be meaningless if resliced...)
-                v[ser].orient[orientt] = True
-
-                # record the smallest instance number for each (sub-)series
-                # (this is just used as a sort key)
-                if v[ser].instance > instance:
-                    v[ser].instance = instance
-
-                sliceoff = 10000.0 * (len(v[ser].orient)-1)
-                sliceind = sliceoff + float(slice)
-
-                v[ser].slices[sliceind] = True
-                v[ser].slicesd[sliceind] = sliced
-                v[ser].echoes[echo] = True
-                v[ser].te[echo] = te
-                v[ser].times[time]   = True
-                v[ser].file[sliceind,time,echo] = f
-                v[ser].end[sliceind,time,echo] = d.end
-                v[ser].pixels[sliceind,time,echo] = pixels
-                v[ser].rescale[sliceind,time,echo] = (intercept, slope)
-                v[ser].mosaic[sliceind,time,echo] = mosaicid
-                v[ser].dtimes[sliceind,time,echo] = dtime
-                v[ser].descrip[sliceind,time,echo] = descrip
-                v[ser].diff[time] = diff
-                v[ser].bval[time] = bval
+                    if self.splitorient:
+                        if rec.no_geometry:
+                            sersuff = 'unk'
+                        elif orientations[study,name][ser].has_key((orientt,ximtype)):
+                            sersuff = orientations[study,name][ser][orientt,ximtype]
+                        else:
+                            sersuff = suffix(len(orientations[study,name][ser]))
+
+                        orientations[study,name][ser][orientt,ximtype] = sersuff
+                        ser = ser + sersuff
+
+                    # updates to v[ser] must happen *after* sersuff has been added
+                    if self.roundorient and \
+                       close_enough is not None and \
+                       old_exact != new_exact:
+
+                            del v[ser].orient[old_exact]
+                            v[ser].orient[lower_exact] = True
+
+                    if not ser in v:
+                        v[ser] = Entity()
+                        v[ser].echoes = {}
+                        v[ser].te     = {}
+                        v[ser].slices = {}
+                        v[ser].slicesd = {}
+                        v[ser].times  = {} # normally from instance numbers
+                        v[ser].dtimes = {} # dynamic time (per-ser, per-vol, or per-slice)
+                        v[ser].file   = {}
+                        v[ser].end    = {}
+                        v[ser].pixtype = {}
+                        v[ser].pixels = {}
+                        v[ser].rescale = {}
+                        v[ser].mosaic = {}
+                        v[ser].diff   = {}
+                        v[ser].bval   = {}
+                        v[ser].descrip = {}
+                        v[ser].shape  = (rec.cols, rec.rows)
+                        v[ser].res    = rec.res
+                        v[ser].desc   = rec.xdesc
+                        v[ser].type   = rec.xtype
+                        v[ser].date   = rec.xdate # study/series date
+                        v[ser].time   = rec.xtime # series/study time
+                        v[ser].stdate = rec.study_date
+                        v[ser].sttime = rec.study_time
+                        v[ser].sar    = rec.sar
+                        v[ser].phase  = rec.phase
+                        v[ser].imtype = ximtype
+                        v[ser].tr     = rec.tr
+                        v[ser].flip   = rec.flip
+                        v[ser].vflip  = rec.vflip
+                        v[ser].table  = rec.table
+                        v[ser].instance_time = rec.instance_time
+                        v[ser].patient_cmt = rec.patient_cmt
+                        v[ser].image_cmt = rec.image_cmt
+                        v[ser].instance = rec.instance
+                        self.seriescount += 1
+                        v[ser].orient = {}
+
+                    # this allows us to catenate multiple orientations
+                    # (in which case we will ignore orientation data!)
+                    # (these will, of course, be meaningless if resliced...)
+                    v[ser].orient[orientt] = True
+
+                    # record the smallest instance number for each (sub-)series
+                    # (this is just used as a sort key)
+                    if v[ser].instance > rec.instance:
+                        v[ser].instance = rec.instance
+
+                    sliceoff = 10000.0 * (len(v[ser].orient)-1)
+                    sliceind = sliceoff + float(rec.slice)
+
+                    v[ser].slices[sliceind] = True
+                    v[ser].slicesd[sliceind] = rec.sliced
+                    v[ser].echoes[echo] = True
+                    v[ser].te[echo] = rec.te
+                    v[ser].times[time]   = True
+                    v[ser].file[sliceind,time,echo] = f
+                    v[ser].end[sliceind,time,echo] = rec.end
+                    v[ser].pixtype[sliceind,time,echo] = rec.pixtype
+                    v[ser].pixels[sliceind,time,echo] = rec.pixels
+                    v[ser].rescale[sliceind,time,echo] = (rec.intercept, rec.slope)
+                    v[ser].mosaic[sliceind,time,echo] = rec.mosaicid
+                    v[ser].dtimes[sliceind,time,echo] = rec.dtime
+                    v[ser].descrip[sliceind,time,echo] = rec.descrip
+                    v[ser].diff[time] = rec.diff
+                    v[ser].bval[time] = rec.bval
                 
-                for w in warnings:
+                    for w in warnings:
+                        errcount += 1
+                        if not errors.has_key(w.err):
+                            errors[w.err] = [w.file]
+                        else:
+                            errors[w.err].append(w.file)
+
+                except DicomError, d:
                     errcount += 1
-                    if not errors.has_key(w.err):
-                        errors[w.err] = [w.file]
+                    if not errors.has_key(d.err):
+                        errors[d.err] = [d.file]
                     else:
-                        errors[w.err].append(w.file)
+                        errors[d.err].append(d.file)
 
-            except DicomError, d:
-                errcount += 1
-                if not errors.has_key(d.err):
-                    errors[d.err] = [d.file]
-                else:
-                    errors[d.err].append(d.file)
-                continue
+                    # (remaining mosaic tiles would fail in the same way)
+                    break
 
 
         # Rename orientation sub-series where possible
@@ -1617,6 +2483,7 @@ class DicomSequenceReader:
                 if e.instance_time:
                     new_file = {}
                     new_end = {}
+                    new_pixtype = {}
                     new_pixels = {}
                     new_times = {}
                     new_dtimes = {}
@@ -1705,6 +2572,7 @@ class DicomSequenceReader:
 
                             new_file[slice, vol_time, echo] = e.file[ste]
                             new_end[slice, vol_time, echo] = e.end[ste]
+                            new_pixtype[slice, vol_time, echo] = e.pixtype[ste]
                             new_pixels[slice, vol_time, echo] = e.pixels[ste]
                             new_rescale[slice, vol_time, echo] = e.rescale[ste]
                             new_mosaic[slice, vol_time, echo] = e.mosaic[ste]
@@ -1723,6 +2591,7 @@ class DicomSequenceReader:
                         e.times = new_times
                         e.file = new_file
                         e.end = new_end
+                        e.pixtype = new_pixtype
                         e.pixels = new_pixels
                         e.rescale = new_rescale
                         e.mosaic = new_mosaic
@@ -1765,11 +2634,20 @@ class DicomSequenceReader:
             else:
                 errors[w.err].append(w.file)
 
+        total = len(self.files)
         puts("\rRead: %i/%i (%i warning%s)     \n"%(n,total,errcount,plural(errcount)))
+
+        if self.cache is not None:
+            puts("Scan cache: %i/%i file%s unchanged\n"%(self.cache.hits,total,plural(total)))
+            self.cache.close()
        
         for k in errors.keys():
-            puts("Warning: %s (repeated %d time%s)\n"%(k,len(errors[k]),plural(len(errors[k]))))
-            if self.show_error_eg: puts("     eg: %s\n"%(errors[k][0],))
+            count, eg = rejects.get(k, [0, None])
+            count += len(errors[k])
+            if eg is None:
+                eg = errors[k][0]
+            puts("Warning: %s (repeated %d time%s)\n"%(k,count,plural(count)))
+            if self.show_error_eg: puts("     eg: %s\n"%(eg,))
 
     def volumecount(self):
         volumes = 0
@@ -1931,172 +2809,195 @@ class DicomSequenceReader:
         data in a future release, but at the moment that would break compatibility.
         """
 
-        out = "["
+        out = StringIO.StringIO()
+        self.writejson(out,filenames,alias,axes)
+        return out.getvalue()
+
+    def writejson(self,fh,filenames={},alias=None,axes={},only=None):
+        """
+        Write the JSON index (see tojson) to fh a series at a time, rather
+        than building it all in memory.  With only=(study,series), just
+        that series: a sidecar index for its volumes
+        """
+
+        fh.write("[")
         firstser = True
         for study in self.studies:
+            if only and study != only[0]:
+                continue
             if not firstser:
-                out += ',\n'
+                fh.write(',\n')
             else:
                 firstser = False
-            out += '{\n'
+            out = '{\n'
             out += '  "type": "study",\n'
-            out += '  "id": "%s",\n' % study[0]
+            out += '  "id": %s,\n' % json_string(study[0])
             if self.change_name:
-                out += '  "name": "%s",\n' % self.change_name
+                out += '  "name": %s,\n' % json_string(self.change_name)
             else:
-                out += '  "name": "%s",\n' % study[1]
+                out += '  "name": %s,\n' % json_string(study[1])
 
             out += '  "series": [\n'
+            fh.write(out)
+
             ksort = self.studies[study].keys()[:]
             ksort.sort(lambda a,b: cmp(fixser(a),fixser(b)))
             first = True
             for k in ksort:
 
+                if only and k != only[1]:
+                    continue
+
                 if alias:
                     if not alias.match(study[0], study[1], k):
                         continue
 
                 e = self.studies[study][k]
                 if not first:
-                    out += ',\n'
+                    fh.write(',\n')
                 else:
                     first = False
 
-                out += '  {\n'
-                out += '    "type": "series",\n'
-                out += '    "id": "%s",\n' % k
-                out += '    "rows": %d,\n' % e.shape[0]
-                out += '    "cols": %d,\n' % e.shape[1]
-                out += '    "slices": %d,\n' % len(e.slices)
-                out += '    "times": %d,\n' % len(e.times)
-                out += '    "echoes": %d,\n' % len(e.echoes)
-                out += '    "flip_var": "%s",\n' % e.vflip
-                out += '    "flip": %g,\n' % e.flip
-                out += '    "reptimes": [%g],\n' % e.tr
-                
-                tmpechoes = [("%g"% (float(e.te[x]),)) for x in e.echoes.keys()]
-                out += '    "echotimes": [%s],\n' % (', '.join(tmpechoes))
+                fh.write(self.seriesjson(study,k,e,filenames,axes))
+
+            fh.write('\n  ]\n}')
+        fh.write(']\n')
+
+    def seriesjson(self,study,k,e,filenames={},axes={}):
+        """JSON record for series k of study, as in the index"""
+
+        out = '  {\n'
+        out += '    "type": "series",\n'
+        out += '    "id": %s,\n' % json_string(k)
+        out += '    "rows": %d,\n' % e.shape[0]
+        out += '    "cols": %d,\n' % e.shape[1]
+        out += '    "slices": %d,\n' % len(e.slices)
+        out += '    "times": %d,\n' % len(e.times)
+        out += '    "echoes": %d,\n' % len(e.echoes)
+        out += '    "flip_var": %s,\n' % json_string(e.vflip)
+        out += '    "flip": %g,\n' % e.flip
+        out += '    "reptimes": [%g],\n' % e.tr
+        
+        tmpechoes = [("%g"% (float(e.te[x]),)) for x in e.echoes.keys()]
+        out += '    "echotimes": [%s],\n' % (', '.join(tmpechoes))
 
-                if not e.table is None:
-                    out += '    "table": [%s],\n' % (', '.join([str(x) for x in e.table]),)
+        if not e.table is None:
+            out += '    "table": [%s],\n' % (', '.join([str(x) for x in e.table]),)
 
-                if not e.patient_cmt is None:
-                    out += '    "patient_cmt": "%s",\n' % e.patient_cmt
-                
-                if not e.image_cmt is None:
-                    out += '    "image_cmt": "%s",\n' % e.image_cmt
-
-                if not e.sar is None:
-                    out += '    "sar": {\n'
-                    out += '        "mode": %d,\n' % (e.sar['mode'],)
-                    out += '        "most_crit": "%s",\n' % (e.sar['most_crit'],)
-                    out += '        "value_lim":  %g,\n' % (e.sar['values'][0],)
-                    out += '        "value_1":  %g,\n' % (e.sar['values'][1],)
-                    out += '        "value_2":  %g,\n' % (e.sar['values'][2],)
-                    out += '        "value_body": %g\n' % (e.sar['body'],)
-                    out += '    },\n'
-
-                if not e.phase is None:
-                    out += '    "phase": {\n'
-                    out += '        "axis": "%s",\n' % (e.phase['axis'],)
-
-                    if axes.has_key((study[0],study[1],k)):
-                        a = axes[study[0],study[1],k]
-                        out_axis = orient.map_axis(e.phase['axis'],a)
-                        out += '        "axis_out": "%s",\n' % (out_axis,)
-                    
-                    out += '        "direction": "%s",\n' % (e.phase['direction'],)
-                    out += '        "positive": %d\n' % (e.phase['positive'],)
+        if not e.patient_cmt is None:
+            out += '    "patient_cmt": %s,\n' % json_string(e.patient_cmt)
+        
+        if not e.image_cmt is None:
+            out += '    "image_cmt": %s,\n' % json_string(e.image_cmt)
+
+        if not e.sar is None:
+            out += '    "sar": {\n'
+            out += '        "mode": %d,\n' % (e.sar['mode'],)
+            out += '        "most_crit": %s,\n' % (json_string(e.sar['most_crit']),)
+            out += '        "value_lim":  %g,\n' % (e.sar['values'][0],)
+            out += '        "value_1":  %g,\n' % (e.sar['values'][1],)
+            out += '        "value_2":  %g,\n' % (e.sar['values'][2],)
+            out += '        "value_body": %g\n' % (e.sar['body'],)
+            out += '    },\n'
+
+        if not e.phase is None:
+            out += '    "phase": {\n'
+            out += '        "axis": %s,\n' % (json_string(e.phase['axis']),)
+
+            if axes.has_key((study[0],study[1],k)):
+                a = axes[study[0],study[1],k]
+                out_axis = orient.map_axis(e.phase['axis'],a)
+                out += '        "axis_out": %s,\n' % (json_string(out_axis),)
+            
+            out += '        "direction": %s,\n' % (json_string(e.phase['direction']),)
+            out += '        "positive": %d\n' % (e.phase['positive'],)
 
-                    out += '    },\n'
-                
-                if len(e.times) > 1:
-                    out += '    "interval": %.4g,\n' % (self.interval(e),)
-                
-                if e.bval.values()[0] != None:
-                    t = [int(x) for x in e.times]; t.sort(); t = [str(x) for x in t]
-
-                    # diffusion in the DICOM [x,y,z] co-ordinates
-                    out += '    "diffusion": [\n'
-                    first=1
-                    for tn in t:
-                        if first==0:
-                            out += ',\n'
-                        first=0
-                        if len(e.diff[tn]) < 3:
-                            out += '        [%g, null]' % (e.bval[tn])
-                        else:
-                            out += '        [%g, [%g, %g, %g]]' % (e.bval[tn], e.diff[tn][0], e.diff[tn][1], e.diff[tn][2])
-                    out += '\n    ],\n'
-                    
-                    # diffusion aligned to the DICOM [i,j,k] image grid
-                    #
-                    # (NB we use OrientedImage here re-initialized from the original DICOM
-                    # orientation field for this series)
-                    out += '    "diffusiongrid": [\n'
-                    o = orient.OrientedImage(None,e.res,e.orient.keys())
-                    first=1
-                    for tn in t:
-                        if first==0:
-                            out += ',\n'
-                        first=0
-                        if len(e.diff[tn]) < 3:
-                            out += '        [%g, null]' % (e.bval[tn])
-                        else:
-                            egrid = o.dcm_to_grid(e.diff[tn])
-                            out += '        [%g, [%g, %g, %g]]' % (e.bval[tn], egrid[0], egrid[1], egrid[2])
-                    out += '\n    ],\n'
-
-                out += '    "desc": "%s",\n' % e.desc
-                out += '    "type": "%s",\n' % e.type
-
-                # Axes mappings:
-                #
-                # This records the DICOM-to-output axis mappings for the conversion.  We only allow
-                # for very simple mappings, flips and 90-degree rotations: a major point of volconv
-                # is to preserve the image and DICOM co-ordinate systems.
-                #
-                # The [i j k] system is the image array: [0 0 0] is the corner voxel of the lowest
-                # slice.  [I J K] is the output image array with [0 0 0] the first voxel stored.
-                # [i j k] and [I J K] indices are always positive; if an axis is flipped, the corner
-                # voxel moves to the opposite end of that axis.
-                #
-                # The [x y z] system is the patient co-ordinate system: [0 0 0] is the DICOM origin.
-                # [X Y Z] of the output format will be an appropriate patient/world co-ordinate
-                # system with the same origin and orthogonal axes.  The anatomical meaning of DICOM
-                # axes is preserved if the output format defines them (eg DICOM LPS -> Nifti RAS).
-
-                if axes.has_key((study[0],study[1],k)):
-                    a = axes[study[0],study[1],k]
-
-                    # image axis mappings: depends on reorient/flip parameters
-                    out += '    "grid_axes_map": ["%s", "%s", "%s"],\n' % \
-                        (a[0], a[1], a[2])
-
-                    # patient axis mappings: for DICOM->Nifti, depends purely on standards
-                    out += '    "patient_axes_map": ["-x", "-y", "z"],\n'
+            out += '    },\n'
+        
+        if len(e.times) > 1:
+            out += '    "interval": %.4g,\n' % (self.interval(e),)
+        
+        if e.bval.values()[0] != None:
+            t = [int(x) for x in e.times]; t.sort(); t = [str(x) for x in t]
+
+            # diffusion in the DICOM [x,y,z] co-ordinates
+            out += '    "diffusion": [\n'
+            first=1
+            for tn in t:
+                if first==0:
+                    out += ',\n'
+                first=0
+                if len(e.diff[tn]) < 3:
+                    out += '        [%g, null]' % (e.bval[tn])
+                else:
+                    out += '        [%g, [%g, %g, %g]]' % (e.bval[tn], e.diff[tn][0], e.diff[tn][1], e.diff[tn][2])
+            out += '\n    ],\n'
+            
+            # diffusion aligned to the DICOM [i,j,k] image grid
+            #
+            # (NB we use OrientedImage here re-initialized from the original DICOM
+            # orientation field for this series)
+            out += '    "diffusiongrid": [\n'
+            o = orient.OrientedImage(None,e.res,e.orient.keys())
+            first=1
+            for tn in t:
+                if first==0:
+                    out += ',\n'
+                first=0
+                if len(e.diff[tn]) < 3:
+                    out += '        [%g, null]' % (e.bval[tn])
+                else:
+                    egrid = o.dcm_to_grid(e.diff[tn])
+                    out += '        [%g, [%g, %g, %g]]' % (e.bval[tn], egrid[0], egrid[1], egrid[2])
+            out += '\n    ],\n'
 
-                if self.use_exdcm:
-                    if self.exdcm_path:
-                        fn = e.file[sorted(e.file.keys())[0]]
-                    else:
-                        fn = basename(e.file[sorted(e.file.keys())[0]])
-                    out += '    "exdcm": "%s",\n' % fn
+        out += '    "desc": %s,\n' % json_string(e.desc)
+        out += '    "type": %s,\n' % json_string(e.type)
 
-                if filenames.has_key((study[0],study[1],k)):
-                    fn = basename(filenames[study[0],study[1],k])
-                    if fn.endswith('.nii') or fn.endswith('.nii.gz'):
-                        out += '    "nii": "%s",\n' % fn
-                    elif fn.endswith('.gipl') or fn.endswith('.gipl.gz'):
-                        out += '    "gipl": "%s",\n' % fn
-
-                out += '    "date": "%s",\n' % e.date
-                out += '    "time": "%s"\n' % e.time
-                out += '  }'
-            out += '\n  ]\n'
-            out += "}"
-        out += ']\n'
-        return(out)
+        # Axes mappings:
+        #
+        # This records the DICOM-to-output axis mappings for the conversion.  We only allow
+        # for very simple mappings, flips and 90-degree rotations: a major point of volconv
+        # is to preserve the image and DICOM co-ordinate systems.
+        #
+        # The [i j k] system is the image array: [0 0 0] is the corner voxel of the lowest
+        # slice.  [I J K] is the output image array with [0 0 0] the first voxel stored.
+        # [i j k] and [I J K] indices are always positive; if an axis is flipped, the corner
+        # voxel moves to the opposite end of that axis.
+        #
+        # The [x y z] system is the patient co-ordinate system: [0 0 0] is the DICOM origin.
+        # [X Y Z] of the output format will be an appropriate patient/world co-ordinate
+        # system with the same origin and orthogonal axes.  The anatomical meaning of DICOM
+        # axes is preserved if the output format defines them (eg DICOM LPS -> Nifti RAS).
+
+        if axes.has_key((study[0],study[1],k)):
+            a = axes[study[0],study[1],k]
+
+            # image axis mappings: depends on reorient/flip parameters
+            out += '    "grid_axes_map": [%s, %s, %s],\n' % \
+                (json_string(a[0]), json_string(a[1]), json_string(a[2]))
+
+            # patient axis mappings: for DICOM->Nifti, depends purely on standards
+            out += '    "patient_axes_map": ["-x", "-y", "z"],\n'
+
+        if self.use_exdcm:
+            if self.exdcm_path:
+                fn = e.file[sorted(e.file.keys())[0]]
+            else:
+                fn = basename(e.file[sorted(e.file.keys())[0]])
+            out += '    "exdcm": %s,\n' % json_string(fn)
+
+        if filenames.has_key((study[0],study[1],k)):
+            fn = basename(filenames[study[0],study[1],k])
+            if fn.endswith('.nii') or fn.endswith('.nii.gz'):
+                out += '    "nii": %s,\n' % json_string(fn)
+            elif fn.endswith('.gipl') or fn.endswith('.gipl.gz'):
+                out += '    "gipl": %s,\n' % json_string(fn)
+
+        out += '    "date": %s,\n' % json_string(e.date)
+        out += '    "time": %s\n' % json_string(e.time)
+        out += '  }'
+        return out
 
 if __name__ == "__main__":
     pass